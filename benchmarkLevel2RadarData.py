@@ -0,0 +1,664 @@
+import argparse, bz2, hashlib, io, json, random, statistics, struct, subprocess, sys, tempfile, time
+import numpy as np
+from bisect import bisect_left, bisect_right, insort
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from glob import glob
+from os import environ, makedirs, path
+from threading import Lock, Thread, Timer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+BUCKET = "noaa-nexrad-level2"
+
+SCRIPT = path.join(path.dirname(path.abspath(__file__)), "downloadLevel2RadarData.py")
+
+# Modules that should only be imported when a run actually needs them
+HEAVY = ["boto3", "botocore", "pandas", "tqdm", "shapely"]
+
+BENCHMARKS = ["startup", "scaling", "memory", "retries", "follow", "thinning", "volumes"]
+
+# Stages of a run that the scaling benchmark times on their own
+STAGES = ["windows", "listing", "filtering", "check", "download"]
+
+# Errors FakeBucket can answer with instead of the real response ("reset" drops the connection)
+FAILURES = {"SlowDown" : 503, "ServiceUnavailable" : 503, "InternalError" : 500}
+
+# First day of the synthetic bucket
+FAKE_START = datetime(2013, 5, 20)
+
+# Runs a script and reports its peak resident memory on stderr, even if it exits with sys.exit
+MEASURE = ("import resource, runpy, sys\n"
+           "sys.argv = sys.argv[1:]\n"
+           "try:\n"
+           "   runpy.run_path(sys.argv[0], run_name = '__main__')\n"
+           "finally:\n"
+           "   print('maxrss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file = sys.stderr)\n")
+
+def main(benchmarks = ["startup"], repeats = 0, outputFile = '', baselineFile = '', tolerance = 0.25,
+         events = [10, 100, 1000], radars = [160], days = [1], volumeSize = 20, workers = 8):
+   for benchmark in benchmarks:
+      if benchmark not in BENCHMARKS:
+         print("Unknown benchmark \"{}\". Choose from: {}".format(benchmark, ", ".join(BENCHMARKS)), flush = True)
+         return 2
+
+   results = {"python" : sys.version.split()[0], "time" : int(time.time())}
+   if "startup" in benchmarks:
+      results["startup"] = startupBenchmark(repeats if repeats else 10)
+   if "scaling" in benchmarks:
+      results["scaling"] = scalingBenchmark(repeats if repeats else 3, events, radars, days, volumeSize * 1000,
+                                            workers)
+   if "memory" in benchmarks:
+      results["memory"] = memoryBenchmark(repeats if repeats else 1, radars, days, workers)
+   if "retries" in benchmarks:
+      results["retries"] = retryChecks()
+   if "follow" in benchmarks:
+      results["follow"] = followChecks()
+   if "thinning" in benchmarks:
+      results["thinning"] = thinningChecks()
+   if "volumes" in benchmarks:
+      results["volumes"] = volumeChecks()
+
+   report = json.dumps(results, indent = 2)
+   if outputFile:
+      with open(outputFile, 'w') as f:
+         f.write(report + '\n')
+   print(report, flush = True)
+
+   # Checks of behavior rather than timings fail the run outright
+   failed = [name for checks in ["retries", "follow", "thinning", "volumes"] for name, result in results.get(checks, {}).items()
+             if not result["passed"]]
+   for name in failed:
+      print("Check {} failed.".format(name), flush = True)
+   if failed:
+      return 1
+
+   # Fail if anything got slower (or, for memory, bigger) than the baseline by more than the tolerance
+   if baselineFile:
+      with open(baselineFile) as f:
+         slower = compareResults(json.load(f), results, tolerance)
+      for name, old, new in slower:
+         print("{} regressed: {:.4f} -> {:.4f}".format(name, old, new), flush = True)
+      return 1 if slower else 0
+
+   return 0
+
+def startupBenchmark(repeats = 10):
+   # Fresh interpreters running -h and a run where everything is cached and already downloaded
+   # (what a cron job polling for new data does most of the time)
+   results = {"help" : timeCommand([sys.executable, SCRIPT, "-h"], repeats)}
+
+   with tempfile.TemporaryDirectory() as outputDir:
+      prepareNoNewFiles(outputDir)
+      command = [sys.executable, SCRIPT, "-o", outputDir, "--ds", "20130520-2000", "--de", "20130520-2100",
+                 "--rad", "KTLX"]
+      results["noNewFiles"] = timeCommand(command, repeats)
+
+   return results
+
+def timeCommand(command, repeats):
+   times = []
+   for repeat in range(repeats):
+      start = time.perf_counter()
+      subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+      times.append(time.perf_counter() - start)
+
+   # -X importtime lists every module that was imported on stderr
+   imports = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], stdout = subprocess.DEVNULL,
+                            stderr = subprocess.PIPE, text = True).stderr
+   loaded = set([line.split('|')[-1].strip() for line in imports.splitlines() if '|' in line])
+
+   return {"median" : statistics.median(times), "min" : min(times), "max" : max(times), "repeats" : repeats,
+           "heavyImports" : [module for module in HEAVY if module in loaded]}
+
+def importScript():
+   if path.dirname(SCRIPT) not in sys.path:
+      sys.path.insert(0, path.dirname(SCRIPT))
+   import downloadLevel2RadarData as dl
+   return dl
+
+def prepareNoNewFiles(outputDir):
+   # Listing cache and manifest for one radar-day, as an earlier run would have left them
+   dl = importScript()
+
+   prefix = "2013/05/20/KTLX/"
+   records = [dl.S3Object("{}KTLX20130520_{:02d}{:02d}00_V06".format(prefix, minute // 60, minute % 60),
+                          1000, 0, '') for minute in range(0, 1440, 5)]
+
+   cache = dl.openListingCache(outputDir + "/.listingCache.sqlite")
+   dl.storeListing(cache, prefix, records)
+   cache.close()
+
+   with redirect_stdout(io.StringIO()):
+      manifest = dl.openManifest(outputDir)
+   for record in records:
+      dl.recordDownload(manifest, record)
+   manifest.close()
+
+def scalingBenchmark(repeats = 3, events = [10, 100, 1000], radars = [160], days = [1], volumeSize = 20000,
+                     workers = 8):
+   # Every combination of bucket size (radars x days) and number of events, against a local
+   # stand-in for the bucket so the timings do not depend on the network
+   environ["TQDM_DISABLE"] = "1"   # progress bars would end up in the JSON
+   dl = importScript()
+   import boto3, pandas   # so the first case does not pay for importing them
+   
+   results = {}
+   for numDays in days:
+      for numRadars in radars:
+         bucket = FakeBucket(radarCodes(numRadars), numDays, volumeSize = volumeSize)
+         try:
+            for numEvents in events:
+               name = "events{}-radars{}-days{}".format(numEvents, numRadars, numDays)
+               results[name] = scalingCase(dl, bucket, numEvents, repeats, workers)
+         finally:
+            bucket.close()
+   
+   return results
+
+def scalingCase(dl, bucket, numEvents, repeats, workers):
+   times = {stage : [] for stage in STAGES + ["endToEnd", "endToEndNoNewFiles"]}
+   
+   with tempfile.TemporaryDirectory() as workDir:
+      caseFile = writeEvents(workDir + "/events.csv", bucket, numEvents)
+      
+      for repeat in range(repeats):
+         with redirect_stdout(io.StringIO()):
+            stageTimes, counts = timeStages(dl, bucket, caseFile, "{}/stages{}".format(workDir, repeat), workers)
+            for stage in STAGES: times[stage].append(stageTimes[stage])
+            
+            # The whole run from a fresh output directory, then again with nothing new to download
+            kwargs = {"outputDir" : "{}/run{}".format(workDir, repeat), "inputFile" : caseFile,
+                      "endpointUrl" : bucket.url, "workers" : workers}
+            for stage in ["endToEnd", "endToEndNoNewFiles"]:
+               start = time.perf_counter()
+               dl.main(**kwargs)
+               times[stage].append(time.perf_counter() - start)
+   
+   result = {"events" : numEvents, "radars" : len(bucket.radars), "days" : bucket.days, "objects" : len(bucket.keys),
+             "repeats" : repeats}
+   result.update(counts)
+   result.update({stage : {"median" : statistics.median(values), "min" : min(values), "max" : max(values)}
+                  for stage, values in times.items()})
+   return result
+
+def timeStages(dl, bucket, caseFile, outputDir, workers):
+   # The same steps a run goes through, one after another so each can be timed on its own
+   times = {}
+   makedirs(outputDir)
+   
+   start = time.perf_counter()
+   windows, numWindows = dl.mergeWindowChunks(dl.useCSV(caseFile, "radar", " ", "domain", ", ", "timestamp",
+                                              "startDate", "endDate", "%Y%m%d-%H%M", 300, '', '', '', ''))
+   prefixes = dl.prefixesForWindows(*windows)
+   times["windows"] = time.perf_counter() - start
+   
+   noaas3 = dl.makeS3Client(workers, bucket.url)
+   start = time.perf_counter()
+   with ThreadPoolExecutor(workers) as pool:
+      listings = list(pool.map(lambda prefix: list(dl.listPrefix(noaas3, prefix)), prefixes))
+   times["listing"] = time.perf_counter() - start
+   
+   start = time.perf_counter()
+   selected = []
+   for prefix, records in zip(prefixes, listings):
+      index = dl.TimeIndex.build(records)
+      dayStart = timegm(time.strptime(prefix[0:10], "%Y/%m/%d"))
+      starts, ends = dl.windowsFor(windows, prefix[11:15], dayStart, dayStart + 86400)
+      selected += [index.record(i) for i in index.select(starts, ends)]
+   times["filtering"] = time.perf_counter() - start
+   
+   # Half of the files are already there, so the check finds some of each
+   manifest = dl.openManifest(outputDir)
+   for record in selected[::2]:
+      dl.recordDownload(manifest, record)
+   start = time.perf_counter()
+   existingFiles = dl.manifestEntries(manifest)
+   toDownload = [record for record in selected if not dl.isComplete(record, existingFiles.get(record.key))]
+   times["check"] = time.perf_counter() - start
+   
+   start = time.perf_counter()
+   dl.downloadFiles(noaas3, toDownload, outputDir, dl.TransferScheduler(workers), manifest)
+   times["download"] = time.perf_counter() - start
+   manifest.close()
+   
+   return times, {"mergedWindows" : len(windows[0]), "prefixes" : len(prefixes), "files" : len(selected)}
+
+def memoryBenchmark(repeats = 1, radars = [160], days = [1], workers = 8):
+   # Peak RSS of runs that select every volume of every radar-day in the bucket, so the plan grows
+   # with radars x days. Planning is measured with --sp and checking a saved plan with --up --off,
+   # so nothing is downloaded. Each run is a fresh interpreter and includes the imports.
+   results = {}
+   for numDays in days:
+      for numRadars in radars:
+         bucket = FakeBucket(radarCodes(numRadars), numDays, volumeSize = 1000)
+         try:
+            with tempfile.TemporaryDirectory() as outputDir:
+               planFile = outputDir + "/plan.jsonl"
+               end = FAKE_START + timedelta(days = numDays) - timedelta(minutes = 1)
+               plan = [SCRIPT, "-o", outputDir, "--ep", bucket.url, "-w", str(workers), "--sp", planFile,
+                       "--ds", FAKE_START.strftime("%Y%m%d-%H%M"), "--de", end.strftime("%Y%m%d-%H%M"),
+                       "--rad"] + bucket.radars
+               planMB = [peakMemory(plan) for repeat in range(repeats)]
+               usePlanMB = [peakMemory([SCRIPT, "-o", outputDir, "--up", planFile, "--off"])
+                            for repeat in range(repeats)]
+               with open(planFile) as f:
+                  files = sum([1 for line in f])
+         finally:
+            bucket.close()
+         
+         results["radars{}-days{}".format(numRadars, numDays)] = {"radars" : numRadars, "days" : numDays,
+            "files" : files, "repeats" : repeats,
+            "planMB" : {"median" : statistics.median(planMB), "min" : min(planMB), "max" : max(planMB)},
+            "usePlanMB" : {"median" : statistics.median(usePlanMB), "min" : min(usePlanMB), "max" : max(usePlanMB)}}
+   
+   return results
+
+def peakMemory(command):
+   # Peak resident memory of a run in MB (ru_maxrss is in kB on Linux and in bytes on macOS)
+   stderr = subprocess.run([sys.executable, "-c", MEASURE] + command, stdout = subprocess.DEVNULL,
+                           stderr = subprocess.PIPE, text = True, env = dict(environ, TQDM_DISABLE = "1")).stderr
+   maxrss = int([line.split()[1] for line in stderr.splitlines() if line.startswith("maxrss ")][-1])
+   return maxrss / (1e6 if sys.platform == "darwin" else 1e3)
+
+def retryChecks():
+   # TransferScheduler against a bucket that answers with errors or drops connections, to check
+   # that errors are retried (and only as often as allowed), that the waits back off, and that
+   # throttling halves the number of requests at a time and successes bring it back
+   dl = importScript()
+   bucket = FakeBucket(radarCodes(1), 1, volumesPerDay = 10, volumeSize = 1000)
+   noaas3 = dl.makeS3Client(1, bucket.url)
+   prefix = bucket.keys[0][:bucket.keys[0].rfind('/') + 1]
+   results = {}
+   
+   def attempt(scheduler, *failures):
+      bucket.fail(*failures)
+      requests, start = bucket.requests, time.perf_counter()
+      try:
+         records = scheduler.run(lambda: list(dl.listPrefix(noaas3, prefix)))
+      except Exception as err:
+         records = err
+      return records, bucket.requests - requests, time.perf_counter() - start
+   
+   try:
+      scheduler = dl.TransferScheduler(8, retries = 3, backoff = 0.01)
+      records, requests, seconds = attempt(scheduler, "InternalError", "reset")
+      results["retried"] = {"passed" : isinstance(records, list) and len(records) == 12 and requests == 3 and
+                            scheduler.retried == 2, "requests" : requests, "retried" : scheduler.retried}
+      
+      scheduler = dl.TransferScheduler(8, retries = 2, backoff = 0.01)
+      records, requests, seconds = attempt(scheduler, *["InternalError"] * 5)
+      bucket.failures = []
+      results["retryLimit"] = {"passed" : isinstance(records, Exception) and requests == 3, "requests" : requests}
+      
+      # Waits are drawn from [0, backoff * 2^attempt] (at most maxBackoff), so three retries wait
+      # 0.7 s on average with a backoff of 0.1 s, at most 1.4 s, and at most 0.6 s when capped at 0.2 s
+      waits = [attempt(dl.TransferScheduler(8, retries = 3, backoff = 0.1), *["InternalError"] * 3)[2]
+               for repeat in range(5)]
+      capped = [attempt(dl.TransferScheduler(8, retries = 3, backoff = 0.1, maxBackoff = 0.2), *["InternalError"] * 3)[2]
+                for repeat in range(5)]
+      results["backoff"] = {"passed" : max(waits) < 1.4 + 0.5 and 0.2 < statistics.mean(waits) and
+                            max(capped) < 0.6 + 0.5, "meanSeconds" : statistics.mean(waits),
+                            "maxSeconds" : max(waits), "maxCappedSeconds" : max(capped)}
+      
+      scheduler = dl.TransferScheduler(8, retries = 3, backoff = 0.01)
+      records, requests, seconds = attempt(scheduler, "SlowDown", "SlowDown")
+      halved = scheduler.limit
+      for repeat in range(halved):
+         attempt(scheduler)
+      results["throttle"] = {"passed" : isinstance(records, list) and scheduler.throttled == 2 and halved == 2 and
+                             scheduler.limit == 3, "limitAfterThrottling" : halved,
+                             "limitAfterSuccesses" : scheduler.limit}
+      
+      # Missing objects are not worth retrying
+      scheduler = dl.TransferScheduler(8, retries = 3, backoff = 0.01)
+      requests = bucket.requests
+      try:
+         scheduler.run(noaas3.head_object, Bucket = BUCKET, Key = prefix + "missing")
+         raised = False
+      except Exception as err:
+         raised = dl.errorKind(err) is None
+      results["notRetried"] = {"passed" : raised and bucket.requests - requests == 1 and scheduler.retried == 0,
+                               "requests" : bucket.requests - requests}
+   finally:
+      bucket.close()
+   
+   return results
+
+def followChecks():
+   # Follows the bucket's day as if it were today, with a volume added after the first poll, to
+   # check that the new volume (and only it) is downloaded and recorded in the manifest. The
+   # second run starts with listings that fail until the retries run out, to check that
+   # following carries on once S3 recovers.
+   dl = importScript()
+   results = {}
+   for name, failures in [("newVolume", []), ("listingRecovers", ["InternalError"] * 2)]:
+      bucket = FakeBucket(radarCodes(2), 1, volumesPerDay = 10, volumeSize = 1000)
+      offset = time.time() - timegm((FAKE_START + timedelta(hours = 23, minutes = 30)).timetuple())
+      radar = bucket.radars[0]
+      key = "{}/{}{}_235959_V06".format(FAKE_START.strftime("%Y/%m/%d/") + radar, radar,
+                                        FAKE_START.strftime("%Y%m%d"))
+      
+      try:
+         with tempfile.TemporaryDirectory() as outputDir:
+            bucket.fail(*failures)
+            Timer(1.5, bucket.add, [[key]]).start()
+            output = io.StringIO()
+            with redirect_stdout(output):
+               try:
+                  dl.follow(outputDir, bucket.radars, dl.TransferScheduler(4, retries = 1, backoff = 0.01),
+                            bucket.url, duration = 5, minInterval = 0.5, maxInterval = 1,
+                            clock = lambda: time.time() - offset)
+                  error = None
+               except Exception as err:
+                  error = err
+               manifest = dl.openManifest(outputDir)
+            entries = dl.manifestEntries(manifest)
+            manifest.close()
+            downloaded = sorted(glob(outputDir + "/*/*/raw/*"))
+            results[name] = {"passed" : error is None and downloaded == [dl.localPath(outputDir, key)] and
+                             entries.get(key, (0,))[0] == len(bucket.body) and
+                             output.getvalue().count("Failed to list") == (1 if failures else 0),
+                             "downloaded" : len(downloaded), "inManifest" : key in entries,
+                             "error" : str(error) if error else None}
+      finally:
+         bucket.close()
+   
+   return results
+
+def thinningChecks():
+   # A batch of two cases whose windows overlap, thinned to one scan per 30 minutes, to check that
+   # every scan each case chose is downloaded (thinning the merged window picks different ones)
+   dl = importScript()
+   bucket = FakeBucket(radarCodes(1), 1, volumesPerDay = 288, volumeSize = 1000)
+   radar, day = bucket.radars[0], FAKE_START.strftime("%Y%m%d")
+   results = {}
+   
+   try:
+      with tempfile.TemporaryDirectory() as outputDir:
+         caseDir = path.join(outputDir, "cases")
+         makedirs(caseDir)
+         for name, start, end in [("a", "1000", "1200"), ("b", "1107", "1300")]:
+            with open(path.join(caseDir, name + ".csv"), 'w') as f:
+               f.write("radar,startDate,endDate\n{},{}-{},{}-{}\n".format(radar, day, start, day, end))
+         
+         output = io.StringIO()
+         with redirect_stdout(output):
+            status = dl.main(outputDir = outputDir, batch = caseDir, endpointUrl = bucket.url, thinInterval = 1800)
+         reports = [line.split(': ')[1].split()[0].split('/') for line in output.getvalue().splitlines()
+                    if line.startswith(caseDir) and "files complete" in line]
+         
+         # The same selections made directly from the index of the radar-day
+         records = [dl.S3Object(key, 1000, 0, '') for key in bucket.keys]
+         index = dl.TimeIndex.build(records)
+         dayStart = timegm(FAKE_START.timetuple())
+         chosen = [index.select(np.array([dayStart + start]), np.array([dayStart + end]), 1800)
+                   for start, end in [(36000, 43200), (40020, 46800)]]
+         wanted = sorted([dl.localPath(outputDir, index.key(i)) for i in np.union1d(*chosen)])
+         downloaded = sorted(glob(outputDir + "/*/*/raw/*"))
+         results["overlappingCases"] = {"passed" : status == 0 and len(reports) == 2 and
+                                        all([complete == total != '0' for complete, total in reports]) and
+                                        downloaded == wanted, "cases" : ["/".join(report) for report in reports],
+                                        "downloaded" : len(downloaded), "chosen" : len(wanted)}
+   finally:
+      bucket.close()
+   
+   return results
+
+def volumeChecks():
+   # Fetches the lowest two elevations (--sw 2) of a synthetic Archive II volume with records of
+   # elevations 1, 1, 2 and 3 after the metadata, once with message 31 radials and once with
+   # message 1 radials. Only the header and the first four records should be written, and the
+   # shorter volume should still decompress to the header and those records' messages.
+   dl = importScript()
+   results = {}
+   for messageType in [31, 1]:
+      volume, header, records = archiveVolume([1, 1, 2, 3], messageType)
+      bucket = FakeBucket(radarCodes(1), 1, volumesPerDay = 2, body = volume)
+      try:
+         with tempfile.TemporaryDirectory() as outputDir:
+            with redirect_stdout(io.StringIO()):
+               status = dl.main(outputDir = outputDir, startDates = [[FAKE_START.strftime("%Y%m%d-0000")]],
+                                endDates = [[FAKE_START.strftime("%Y%m%d-2359")]], radars = [bucket.radars],
+                                endpointUrl = bucket.url, sweeps = 2)
+            expected = header + b''.join([struct.pack(">i", len(record)) + record for record in
+                                          [bz2.compress(record) for record in records[:4]]])
+            written = []
+            for file in sorted(glob(outputDir + "/*/*/raw/*")):
+               with open(file, "rb") as f:
+                  written.append(f.read())
+            
+            expanded, size = b'', 0
+            if written:
+               size = dl.decompressVolume(file, path.join(outputDir, "uncompressed"))
+               with open(path.join(outputDir, "uncompressed"), "rb") as f:
+                  expanded = f.read()
+            results["message{}".format(messageType)] = {"passed" : status == 0 and len(written) == 2 and
+                                                        all([data == expected for data in written]) and
+                                                        expanded == header + b''.join(records[:4]) and
+                                                        size == len(expanded), "volumeBytes" : len(volume),
+                                                        "writtenBytes" : [len(data) for data in written],
+                                                        "expectedBytes" : len(expected)}
+      finally:
+         bucket.close()
+   
+   return results
+
+def archiveVolume(elevations, messageType = 31, radials = 3):
+   # Archive II volume with a metadata record and then one bzip2-compressed LDM record of a few
+   # radials for each elevation number. Returns the volume, its header and the uncompressed records.
+   def message(kind, body):
+      # 12 bytes of CTM, then the message header with the size in halfwords and the type
+      return bytes(12) + struct.pack(">HBBHHIHH", (16 + len(body)) // 2, 0, kind, 0, 0, 0, 1, 1) + body
+   
+   def radial(elevation, azimuth):
+      if messageType == 31:
+         # Data header block, with the elevation number at byte 22
+         return message(31, struct.pack(">4sIHHfBBHBBBBf", b"KAAA", 0, 0, azimuth, azimuth, 0, 0, 0, 1, 0,
+                                        elevation, 0, 0.5 * elevation).ljust(68, b'\0'))
+      # Fixed size message 1, with the coded elevation angle in halfword 8 and the number in halfword 9
+      return message(1, struct.pack(">IHHHHHHH", 0, 0, 0, 0, azimuth, 0, int(0.5 * elevation * 8 * 4096 / 180),
+                                    elevation)).ljust(2432, b'\0')
+   
+   header = b"AR2V0006.001" + bytes(8) + b"KAAA"
+   records = [message(15, bytes(64)).ljust(2432, b'\0') * 2]
+   for elevation in elevations:
+      records.append(b''.join([radial(elevation, azimuth + 1) for azimuth in range(radials)]))
+   volume = header + b''.join([struct.pack(">i", len(record)) + record for record in
+                               [bz2.compress(record) for record in records]])
+   return volume, header, records
+
+def radarCodes(numRadars):
+   # Made up radar codes; only their number matters
+   return ["K" + chr(65 + i // 676) + chr(65 + i // 26 % 26) + chr(65 + i % 26) for i in range(numRadars)]
+
+def writeEvents(file, bucket, numEvents, seed = 0):
+   # Case file of events at random radars and times within the bucket's days
+   rng = random.Random(seed)
+   with open(file, 'w') as f:
+      f.write("radar,timestamp\n")
+      for event in range(numEvents):
+         eventTime = FAKE_START + timedelta(minutes = rng.randrange(bucket.days * 1440))
+         f.write("{},{}\n".format(rng.choice(bucket.radars), eventTime.strftime("%Y%m%d-%H%M")))
+   return file
+
+class FakeBucket:
+   # Local stand-in for the NEXRAD bucket that answers the listing and download requests the script
+   # makes, served over HTTP so runs can point --ep (endpointUrl) at it
+   def __init__(self, radars, days, volumesPerDay = 250, volumeSize = 20000, seed = 0, body = None):
+      rng = random.Random(seed)
+      self.radars, self.days = radars, days
+      keys = []
+      for day in range(days):
+         date = FAKE_START + timedelta(days = day)
+         for radar in radars:
+            prefix = "{}/{}/{}{}_".format(date.strftime("%Y/%m/%d"), radar, radar, date.strftime("%Y%m%d"))
+            names = ["{:02d}{:02d}{:02d}_V06".format(s // 3600, s // 60 % 60, s % 60)
+                     for s in sorted(rng.sample(range(86400), volumesPerDay))]
+            keys += [prefix + name for name in names]
+            
+            # The real bucket also has these, and they have to be filtered out
+            keys += [prefix + rng.choice(names) + "_MDM", prefix + rng.choice(names) + ".001"]
+      
+      self.keys = sorted(keys)
+      self.body = bytes(volumeSize) if body is None else body
+      
+      # Errors to answer the next requests with (see fail), and how many requests came in
+      self.failures = []
+      self.requests = 0
+      self.lock = Lock()
+      self.etag = '"{}"'.format(hashlib.md5(self.body).hexdigest())
+      
+      self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBucketHandler)
+      self.server.daemon_threads = True
+      self.server.bucket = self
+      self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+      Thread(target = self.server.serve_forever, daemon = True).start()
+   
+   def list(self, prefix, after, maxKeys):
+      with self.lock:
+         start = max(bisect_left(self.keys, prefix), bisect_right(self.keys, after) if after else 0)
+         end = bisect_left(self.keys, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else len(self.keys)
+         return self.keys[start:min(end, start + maxKeys)], start + maxKeys < end
+   
+   def add(self, keys):
+      # New volumes show up in the bucket while it is being followed
+      with self.lock:
+         for key in keys:
+            insort(self.keys, key)
+   
+   def fail(self, *failures):
+      # The next requests get these errors (names from FAILURES, or "reset") in order
+      with self.lock:
+         self.failures += failures
+   
+   def nextFailure(self):
+      with self.lock:
+         self.requests += 1
+         return self.failures.pop(0) if self.failures else None
+   
+   def exists(self, key):
+      index = bisect_left(self.keys, key)
+      return index < len(self.keys) and self.keys[index] == key
+   
+   def close(self):
+      self.server.shutdown()
+      self.server.server_close()
+
+class FakeBucketHandler(BaseHTTPRequestHandler):
+   protocol_version = "HTTP/1.1"
+   
+   def log_message(self, *args):
+      pass
+   
+   def do_HEAD(self):
+      self.respond(False)
+   
+   def do_GET(self):
+      self.respond(True)
+   
+   def respond(self, sendBody):
+      bucket = self.server.bucket
+      failure = bucket.nextFailure()
+      if failure == "reset":
+         # Close the connection without answering, like a reset
+         self.close_connection = True
+         return
+      if failure:
+         body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{}</Code></Error>'.format(failure).encode()
+         self.send(FAILURES[failure], body, {"Content-Type" : "application/xml"}, sendBody)
+         return
+      
+      url = urlparse(self.path)
+      key = unquote(url.path).lstrip('/').partition('/')[2]
+      
+      if not key:
+         # ListObjectsV2
+         query = parse_qs(url.query)
+         prefix = query.get("prefix", [''])[0]
+         after = max(query.get("start-after", [''])[0], query.get("continuation-token", [''])[0])
+         keys, truncated = bucket.list(prefix, after, int(query.get("max-keys", ["1000"])[0]))
+         contents = "".join(["<Contents><Key>{}</Key><LastModified>2013-05-21T00:00:00.000Z</LastModified>"
+                             "<ETag>{}</ETag><Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>".format(
+                             escape(key), escape(bucket.etag), len(bucket.body)) for key in keys])
+         token = "<NextContinuationToken>{}</NextContinuationToken>".format(escape(keys[-1])) if truncated else ''
+         body = ('<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/'
+                 '2006-03-01/"><Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount><MaxKeys>1000</MaxKeys>'
+                 '<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>').format(BUCKET, escape(prefix), len(keys),
+                 "true" if truncated else "false", token, contents).encode()
+         self.send(200, body, {"Content-Type" : "application/xml"}, sendBody)
+      elif not bucket.exists(key):
+         body = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code></Error>'
+         self.send(404, body, {"Content-Type" : "application/xml"}, sendBody)
+      else:
+         # GetObject, with the byte ranges boto3 uses for larger files
+         body, status, headers = bucket.body, 200, {"ETag" : bucket.etag, "Accept-Ranges" : "bytes",
+                                                    "Last-Modified" : "Tue, 21 May 2013 00:00:00 GMT"}
+         byteRange = self.headers.get("Range", '')
+         if byteRange.startswith("bytes="):
+            first, last = byteRange[6:].split('-')
+            first, last = int(first), min(int(last) if last else len(body) - 1, len(body) - 1)
+            headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, len(body))
+            body, status = body[first:last + 1], 206
+         self.send(status, body, headers, sendBody)
+   
+   def send(self, status, body, headers, sendBody):
+      self.send_response(status)
+      for name, value in headers.items():
+         self.send_header(name, value)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      if sendBody:
+         self.wfile.write(body)
+
+def compareResults(baseline, results, tolerance, name = ''):
+   # Looks for timings (dicts with a median) at any depth of the results
+   slower = []
+   for key, result in results.items():
+      if not isinstance(result, dict):
+         continue
+      old = baseline.get(key, {}) if isinstance(baseline, dict) else {}
+      if "median" in result:
+         if "median" in old and result["median"] > old["median"] * (1 + tolerance):
+            slower.append((name + key, old["median"], result["median"]))
+      else:
+         slower += compareResults(old, result, tolerance, name + key + '.')
+   return slower
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description = "Benchmarks for downloadLevel2RadarData.py. "
+            "Results are printed (and optionally saved) as JSON so they can be compared between versions.")
+   parser.add_argument("benchmarks", metavar = "benchmark", type = str, nargs = '*', default = ["startup"],
+                       help = "Benchmarks to run (startup, scaling, memory, retries, follow, thinning, volumes). retries "
+                       "checks retries, backoff and throttling against failures from a local bucket, follow checks that "
+                       "--fl downloads a volume added to it, thinning checks that --ti in a batch downloads every scan "
+                       "of overlapping cases, and volumes checks --sw on synthetic Archive II volumes. They exit with 1 "
+                       "if any check fails. Default = startup")
+   parser.add_argument("-n", metavar = "repeats", type = int, nargs = '?', default = 0,
+                       help = "Number of times to repeat each timing. Default = 10 for startup, 3 for scaling, "
+                       "1 for memory.")
+   parser.add_argument("-o", metavar = "outputFile", type = str, nargs = '?', default = '',
+                       help = "Path to save the JSON results to.")
+   parser.add_argument("-c", metavar = "baselineFile", type = str, nargs = '?', default = '',
+                       help = "JSON results of an earlier run to compare against. Exits with 1 if anything "
+                       "is slower by more than the tolerance.")
+   parser.add_argument("-t", metavar = "tolerance", type = float, nargs = '?', default = 0.25,
+                       help = "Allowed slowdown compared to the baseline (0.25 = 25%%). Default = %(default)s.")
+   parser.add_argument("--ev", metavar = "events", type = int, nargs = '*', default = [10, 100, 1000],
+                       help = "Numbers of events in the scaling benchmark's case file. Default = %(default)s.")
+   parser.add_argument("--nr", metavar = "radars", type = int, nargs = '*', default = [160],
+                       help = "Numbers of radars in the scaling and memory benchmarks' bucket. Default = %(default)s.")
+   parser.add_argument("--nd", metavar = "days", type = int, nargs = '*', default = [1],
+                       help = "Numbers of days in the scaling and memory benchmarks' bucket. Default = %(default)s.")
+   parser.add_argument("--vs", metavar = "volumeSize", type = int, nargs = '?', default = 20,
+                       help = "Size of each volume in the scaling benchmark's bucket in kB. Default = %(default)s.")
+   parser.add_argument("-w", metavar = "workers", type = int, nargs = '?', default = 8,
+                       help = "Number of files to list and download at a time. Default = %(default)s.")
+   args = parser.parse_args(sys.argv[1:])
+
+   sys.exit(main(benchmarks = args.benchmarks, repeats = args.n, outputFile = args.o, baselineFile = args.c,
+                 tolerance = args.t, events = args.ev, radars = args.nr, days = args.nd, volumeSize = args.vs,
+                 workers = args.w))
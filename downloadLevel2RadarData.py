@@ -1,220 +1,1734 @@
-import argparse, boto3, sys, time
+import argparse, bz2, gzip, hashlib, heapq, json, random, shutil, sys, time, zlib
 import numpy as np
-import pandas as pd
 import re
-from botocore import UNSIGNED
-from botocore.client import Config
+import sqlite3
 from calendar import timegm
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import date, datetime, timedelta
+from functools import lru_cache, reduce
 from glob import glob
-from os import path, system
-from shapely.geometry import polygon, Point
-from tqdm import tqdm
+from os import cpu_count, getpid, link, makedirs, path, remove, replace, scandir, symlink, system
+from queue import Queue
+from threading import Condition, Lock, Thread, get_ident
+# boto3, pandas and tqdm are slow to import, so they are only imported by the functions that
+# need them. That keeps -h and runs with nothing new to download fast.
+
+BUCKET = "noaa-nexrad-level2"
+
+# What is kept from each object in a bucket listing
+S3Object = namedtuple("S3Object", ["key", "size", "lastModified", "etag"])
+
+# Error codes that mean S3 wants us to slow down, and ones that are worth trying again
+THROTTLE_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests",
+                  "503", "429"}
+RETRY_CODES = {"InternalError", "ServiceUnavailable", "RequestTimeout", "500", "502", "504"}
+
+# Where NSE data is rsynced from, and the archive roots on it to try in order
+NSE_SOURCE = "wdssii@hwtarchive.hwt.nssl:/data6"
+NSE_ROOTS = ["NSE", "NSE_Rebuild/NSE_organized", "NSE_Rebuild/NSE"]
+
+# Marks times in an input file that could not be parsed
+NO_TIME = np.iinfo(np.int64).min
+
+# Archive II volumes: a 24-byte volume header, then LDM records that are each a 4-byte size and a
+# bzip2 block of messages. Each message has a 12-byte CTM header and a 16-byte message header;
+# message 31 (radials) is as long as its header says and every other message takes 2432 bytes.
+VOLUME_HEADER = 24
+MESSAGE_HEADER = 28
+MESSAGE_SIZE = 2432
+
+# Linux ioctl that makes a copy-on-write clone of a file (a reflink) on Btrfs, XFS and similar
+FICLONE = 0x40049409
+
+# One entry of a radar-day's time index (see TimeIndex)
+INDEX_ENTRY = np.dtype([("time", "<i8"), ("offset", "<i8"), ("size", "<i8"), ("lastModified", "<i8"),
+                        ("etag", "S34")])
+
+# Archive days stop changing once this long has passed since the end of the day
+IMMUTABLE_AFTER = 6 * 3600
 
 def main(outputDir = "temp", dateFormat = "%Y%m%d-%H%M", startDates = [], endDates = [],
          inputFile = '', copyST = False, copyNRE = False, printFileList = False,
          radars = [], radarName = "radar", radarSep = " ", timeStampName = "timestamp", domainName = "domain",
          domainSep = ", ", startTimeName = "startDate", endTimeName = "endDate", timeThreshold = 300,
-         domains = [], radarFile = '', latName = '', lonName = '', radarCol = ''):   
+         domains = [], radarFile = '', latName = '', lonName = '', radarCol = '', workers = 8,
+         endpointUrl = None, cacheFile = '', cacheTTL = 300, offline = False, radarRange = 0,
+         chunkSize = 100000, rebuildManifest = False, resume = False, retries = 5, maxRate = 0,
+         batch = '', followMode = False, followDuration = 0, nseSource = NSE_SOURCE, sweeps = -1, maxBytes = 0,
+         decompress = False, decompressWorkers = 0, thinInterval = 0, everyNth = 0, shard = '', savePlan = '',
+         usePlan = '', verifyPlanFile = '', storeDir = '', storeBudget = 0, linkMode = "hard"):   
+   metrics.reset()
+   decompressWorkers = (decompressWorkers if decompressWorkers > 0 else cpu_count() or 1) if decompress else 0
    if not path.exists(outputDir):
       print("Output directory {} does not exist. Creating directory.".format(outputDir), flush = True)
       system("mkdir -p {}".format(outputDir))      
    
-   if not "%Y" or not "%m" or not "%d" in dateFormat:
-      print("\"{}\" is not a valid date format".format(dateFormat), flush = True)
-      return 0
-
-   if inputFile == '':
+   # Retries, backoff, concurrency and bandwidth for all of the requests to S3
+   scheduler = TransferScheduler(workers, retries, maxRate = maxRate * 1e6)
+   
+   # Volumes that other output directories already downloaded are linked from the shared store
+   store = SharedStore(storeDir, storeBudget * 1e9, linkMode) if storeDir else None
+   
+   # Several nodes can share an output tree by each taking the radar-days of one shard. Each
+   # shard keeps its own manifest and listing cache so the nodes never write to the same file.
+   if shard:
+      shard = parseShard(shard)
+      if shard is None:
+         return 1
+   
+   # Check that every file of a saved plan was downloaded by one of the shards
+   if verifyPlanFile:
+      return verifyPlan(outputDir, verifyPlanFile, volumePart(sweeps, maxBytes))
+   
+   # Carry on with the plan of an interrupted run without listing or checking anything again
+   if resume:
+      manifest = openManifest(outputDir, rebuildManifest, shard)
+      plannedFiles, filesToDownload, complete = readJournal(manifest)
+      if plannedFiles:
+         print("Resuming {} of {} planned files from the journal.".format(len(filesToDownload), len(plannedFiles)),
+               flush = True)
+         runPlan(manifest, None, plannedFiles, filesToDownload, outputDir, scheduler, endpointUrl, copyST, copyNRE,
+                 nseSource, sweeps, maxBytes, decompressWorkers, nseIndex = not shard, store = store)
+         if not complete:
+            print("The interrupted run had not finished planning. Run it again without --rs to plan the rest.",
+                  flush = True)
+         return 0
+      print("Nothing to resume in {}.".format(outputDir), flush = True)
+      manifest.close()
+   
+   # Keep downloading new volumes of the radars as they show up in the bucket
+   if followMode:
       if (len(radars) == 0) and (len(domains) != 0):
          if radarFile == '':
             print("No list of radars supplied. Please provide a CSV with radar lats and lons.", flush = True)
-            exit()
-         radars = getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol)
-         print("Radars in domain:")
-         print(radars)
-      if (len(startDates) == 0 ) or (len(endDates) == 0) or (len(radars) == 0):
-         print("One of the range/radar variables is empty and no input file is specified.", flush = True)
+            return 1
+         try:
+            radars = getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol, radarRange)
+         except (OSError, ValueError) as err:
+            print("Could not find radars in the domains: {}".format(err), flush = True)
+            return 1
+      radars = sorted(set([rad.upper() if len(rad) == 4 else "K" + rad.upper() for radar in radars for rad in radar]))
+      radars = [radar for radar in radars if validRadar(radar)]
+      if len(radars) == 0:
+         print("No valid radars to follow.", flush = True)
          return 0
-      epochTime = useRangeAndRadar(startDates, endDates, radars, dateFormat)
+      follow(outputDir, radars, scheduler, endpointUrl, followDuration, sweeps = sweeps, maxBytes = maxBytes,
+             store = store)
+      return 0
+   
+   if not "%Y" or not "%m" or not "%d" in dateFormat:
+      print("\"{}\" is not a valid date format".format(dateFormat), flush = True)
+      return 0
+   
+   # A batch is a list of case files that are planned and downloaded together. A plan saved
+   # with --sp takes the place of the case files.
+   if usePlan:
+      caseFiles = []
+   elif batch:
+      caseFiles = findCaseFiles(batch)
+      print("Batch of {} case files.".format(len(caseFiles)), flush = True)
    else:
-      if not path.exists(inputFile):
-         print("Input file \"{}\" does not exist.".format(inputFile), flush = True)
-         return 0
+      caseFiles = [inputFile]
    
-      if timeThreshold < 0:
-         print("Time threshold ({}) cannot be negative.".format(timeThreshold), flush = True)
-         return 0
-      epochTime = useCSV(inputFile, radarName, radarSep, domainName, domainSep, timeStampName, startTimeName, 
-                         endTimeName, dateFormat, timeThreshold, radarFile, latName, lonName, radarCol)
+   cases = []
+   start = time.perf_counter()
+   for caseFile in caseFiles:
+      if caseFile == '':
+         if (len(radars) == 0) and (len(domains) != 0):
+            if radarFile == '':
+               print("No list of radars supplied. Please provide a CSV with radar lats and lons.", flush = True)
+               return 1
+            try:
+               radars = getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol, radarRange)
+            except (OSError, ValueError) as err:
+               print("Could not find radars in the domains: {}".format(err), flush = True)
+               return 1
+            print("Radars in domain:")
+            print(radars)
+         if (len(startDates) == 0 ) or (len(endDates) == 0) or (len(radars) == 0):
+            print("One of the range/radar variables is empty and no input file is specified.", flush = True)
+            continue
+         try:
+            chunks = [windowArrays(useRangeAndRadar(startDates, endDates, radars, dateFormat))]
+         except ValueError as err:
+            print("Invalid dates or radars: {}.".format(err), flush = True)
+            return 1
+      else:
+         if not path.exists(caseFile):
+            print("Input file \"{}\" does not exist.".format(caseFile), flush = True)
+            continue
+      
+         if timeThreshold < 0:
+            print("Time threshold ({}) cannot be negative.".format(timeThreshold), flush = True)
+            return 0
+         chunks = useCSV(caseFile, radarName, radarSep, domainName, domainSep, timeStampName, startTimeName, 
+                         endTimeName, dateFormat, timeThreshold, radarFile, latName, lonName, radarCol,
+                         radarRange, chunkSize)
+      
+      # Merge overlapping and adjacent windows of each radar so everything after this scales
+      # with how much radar time is covered instead of with the number of entries. A case file
+      # that cannot be read is skipped, so one bad file does not stop a batch.
+      try:
+         windows, numWindows = mergeWindowChunks(chunks)
+      except (OSError, ValueError) as err:
+         print("Skipping {}: {}.".format(caseFile, err), flush = True)
+         continue
+      
+      # Make sure there is input data
+      if numWindows == 0:
+         print("No valid data was found{}. Check that your date/radar format is valid.".format(
+               " in " + caseFile if caseFile else ''), flush = True)
+         continue
+      
+      print("Merged {} windows into {} ({:.1f}% fewer){}.".format(numWindows, len(windows[0]),
+            100 * (1 - len(windows[0]) / numWindows), " for " + caseFile if batch else ''), flush = True)
+      cases.append((caseFile, windows))
    
-   # Make sure there is input data
-   if len(epochTime) == 0:
-      print("No valid data was found. Check that your date/radar format is valid.", flush = True)
+   if len(cases) == 0 and not usePlan:
       return 0
    
-   # Split into more entries if start and end times are more than 1 day apart
+   # Windows of every case together, so prefixes and files shared by cases are only handled once
+   windows, numWindows = mergeWindowChunks([windows for caseFile, windows in cases])
+   metrics.stage("windows", wallSeconds = time.perf_counter() - start, items = len(windows[0]))
+   
    # Make list of prefixes to find the relevant objects from Amazon bucket 
-   prefixList = np.array([[(datetime.utcfromtimestamp(item["start"]).date() +
-                            timedelta(days = numDays)).strftime("%Y/%m/%d/") +
-                           item["radar"] + '/'] for item in epochTime 
-                           for numDays in range((datetime.utcfromtimestamp(item["end"]).date() -
-                                                 datetime.utcfromtimestamp(item["start"]).date()).days + 1)])
-   
-   # Flatten and find unique entries in list
-   prefixList = np.array(list(set([item for sublist in prefixList for item in sublist])))
-      
-   # Setup Anoymous Login for S3 with Amazon 
-   noaas3 = boto3.client("s3", region_name = "us-east-1",
-                         config = Config(signature_version = UNSIGNED))
-   
-   # Make list of files in the bucket for the dates specified
-   print("Finding files to download:", flush = True)
-   objectsInBucket = np.array([noaas3.list_objects_v2(Bucket = "noaa-nexrad-level2",
-                                                      Delimiter = '/', Prefix = prefix)
-                               for prefix in tqdm(prefixList, file = sys.__stdout__)])
-   objectList = np.array([item["Contents"] for item in objectsInBucket if "Contents" in item], dtype=object)
-   # Make sure files are of the right format
-   fileNames = np.array([file["Key"] for object in objectList
-                         for file in object
-                         if "Key" in file and
-                         (file["Key"][file["Key"].rfind('/') + 1:file["Key"].rfind('/') + 13] ==
-                          file["Key"][file["Key"].rfind('/') - 4:file["Key"].rfind('/')] +
-                          file["Key"][0:4] + file["Key"][5:7] + file["Key"][8:10]) and
-                         (file["Key"][-3:] != "MDM") and (file["Key"][-4:] != ".001")])
-   # Make dictionary with the file name, radar, and UNIX time for each file
-   fileInfo = np.array([{"name" : name,
-                         "radar" : name[name.rfind('/') + 1:name.rfind('/') + 5],
-                         "time" : timegm(time.strptime(name[name.rfind('/') + 5:name.rfind('/') + 20],
-                                                       "%Y%m%d_%H%M%S"))} for name in fileNames])
-     
-   radars = np.array([entry["radar"] for entry in fileInfo])
-   
-   if printFileList:
-      print("Files:", flush = True)
-      for file in fileInfo: print(file, flush = True)
-
-   # Filtering out files outside of the time window
-   print("Filtering files to download:", flush = True)
-   filteredFiles = [info["name"] for epoch in tqdm(epochTime, file = sys.__stdout__)
-                    for info in fileInfo[np.where(radars == epoch["radar"])[0]]
-                    if (epoch["start"] <= info["time"] <= epoch["end"])] 
-      
-   filteredFiles.sort()
-   
-   filteredDates = list(set([file[file.rfind('/') + 5:file.rfind('/') + 13] + '/' + file[file.rfind('/') + 1:file.rfind('/') + 5] for file in filteredFiles]))
-      
-   # Make set of existing radar files in specified output directory for skipping downloading existing files
-   print("Finding exisiting files:", flush = True)
-   existingFiles = set([item[item.rfind('/') + 5:item.rfind('/') + 9] + '/' +
-                        item[item.rfind('/') + 9:item.rfind('/') + 11] + '/' +
-                        item[item.rfind('/') + 11:item.rfind('/') + 13] + '/' +
-                        item[item.rfind('/') + 1:item.rfind('/') + 5] + '/' +
-                        item[item.rfind('/') + 1:]
-                        for d in tqdm(filteredDates, file = sys.__stdout__)
-                        for item in glob(outputDir + "/{}/raw/*".format(d))])
-        
-   # Filtering out files that are already in output directory
-   filesToDownload = np.array(list(set(filteredFiles) - existingFiles))
-   
-   filesToDownload.sort()
-   
-   # Return if no files need to be downloaded
-   if len(filesToDownload) == 0:
-      if inputFile:
-         print("No new files to download for {}".format(inputFile), flush = True)
+   prefixList = prefixesForWindows(*windows)
+   plan = readPlan(usePlan) if usePlan else None
+   if plan is not None:
+      prefixList = sorted(plan)
+      print("Plan {} has {} files in {} radar-days.".format(usePlan, sum([len(index) for index in plan.values()]),
+            len(plan)), flush = True)
+   if shard:
+      prefixList = [prefix for prefix in prefixList if shardOf(prefix, shard[1]) == shard[0]]
+      print("Shard {}/{} has {} radar-days.".format(shard[0], shard[1], len(prefixList)), flush = True)
+      
+   # Listing, filtering, checking for existing files, downloading and NSE all run at the same
+   # time, with each prefix handed on to the next stage as soon as it is ready
+   cacheFile = cacheFile if cacheFile else "{}/.listingCache{}.sqlite".format(outputDir, shardSuffix(shard))
+   cache = openListingCache(cacheFile)
+   manifest = openManifest(outputDir, rebuildManifest, shard)
+   # NSE tables come from hwtarchive, so offline runs leave them out
+   tables = (["SoundingTable"] if copyST else []) + (["NearRadarEnvironmentTable"] if copyNRE else [])
+   tables = [] if offline else tables
+   result = runPipeline(prefixList, windows, cases if batch else [], cache, manifest, outputDir, scheduler,
+                        endpointUrl, cacheTTL, offline, printFileList, tables, nseSource, sweeps, maxBytes,
+                        decompressWorkers, path.join(path.dirname(cacheFile), ".timeIndex"), thinInterval, everyNth,
+                        plan = None if plan is None else (plan[prefix].records() for prefix in prefixList),
+                        download = not savePlan, nseIndex = not shard, store = store)
+   cache.close()
+   if savePlan:
+      writePlan(savePlan, manifest)
+      manifest.close()
+      if not result["errors"]:
+         print("Saved a plan of {} files to {}. Download it with --up {} (and --shard i/N on each node).".format(
+               result["planned"], savePlan, savePlan), flush = True)
+         return 0
+   
+   # Prefixes that could not be listed or checked would otherwise look like they had nothing new
+   if result["errors"]:
+      print("The plan is incomplete. Run again to finish it.", flush = True)
+   elif result["toDownload"] == 0:
+      if inputFile or batch:
+         print("No new files to download for {}".format(batch if batch else inputFile), flush = True)
       else:
          print("No new files to download.", flush = True)
-      return 0
+   elif offline:
+      print("Offline mode: not downloading {} files.".format(result["toDownload"]), flush = True)
+   
+   if result["uncached"]:
+      print("{} prefixes were not in the listing cache and were skipped in offline mode.".format(result["uncached"]),
+            flush = True)
+   
+   if not savePlan:
+      reportCases(result["caseScans"], cases if batch else [], manifest, volumePart(sweeps, maxBytes), prefixList)
+      manifest.close()
+   
+   return 1 if result["errors"] else 0
+
+def runPipeline(prefixList, windows, cases, cache, manifest, outputDir, scheduler, endpointUrl, cacheTTL,
+                offline, printFileList, tables, nseSource, sweeps = -1, maxBytes = 0, decompressWorkers = 0,
+                indexDir = '', thinInterval = 0, everyNth = 0, plan = None, download = True, nseIndex = True,
+                store = None):
+   # The SQLite connections and results are shared by the stages, and the S3 client and
+   # progress bar are only made once something needs them. Nothing kept for the whole run grows
+   # with the number of files except the scan times each case selected (8 bytes a file).
+   cacheLock, manifestLock, clientLock, barLock = Lock(), Lock(), Lock(), Lock()
+   clients = []
+   result = {"cached" : 0, "uncached" : 0, "planned" : 0, "toDownload" : 0, "linked" : 0, "failed" : [],
+             "caseScans" : {caseFile : {} for caseFile, caseWindows in cases}, "nseMissing" : [],
+             "nseDates" : set()}
+   
+   def client():
+      with clientLock:
+         if not clients: clients.append(makeS3Client(scheduler.maxWorkers, endpointUrl))
+      return clients[0]
+   
+   bars = []
+   
+   def addBytes(numBytes):
+      with barLock:
+         if not bars:
+            from tqdm import tqdm
+            bars.append(tqdm(total = 0, unit = 'B', unit_scale = True, file = sys.__stdout__))
+         bars[0].total += numBytes
+         bars[0].refresh()
+   
+   # How much of each volume is needed is only known while it is being fetched
+   part = volumePart(sweeps, maxBytes)
+   
+   def progress(numBytes):
+      scheduler.consume(numBytes)
+      with barLock:
+         if part: bars[0].total += numBytes
+         bars[0].update(numBytes)
+   
+   def write(message):
+      with barLock:
+         if bars:
+            bars[0].write(message)
+         else:
+            print(message, flush = True)
+   
+   # Days that are over have a time index saved, so they are not listed or read from the cache
+   # again; otherwise use bucket listings saved by earlier runs where they are still valid
+   def listStage(prefix, emit):
+      indexFile = path.join(indexDir, prefix.rstrip('/')) if indexDir else ''
+      immutable = prefixImmutable(prefix)
+      index = TimeIndex.load(indexFile) if indexFile and immutable else None
+      if index is not None:
+         with cacheLock:
+            result["cached"] += 1
+         metrics.add("prefixesIndexed")
+         emit("filter", (prefix, index))
+         return
+      
+      with cacheLock:
+         records = getCachedListing(cache, prefix, cacheTTL)
+      if records is None:
+         if offline:
+            with cacheLock:
+               result["uncached"] += 1
+            prefixDone(prefix, emit)
+            return
+         # Only the records are kept from the listing responses, and only until they are indexed
+         records = scheduler.run(lambda: list(listPrefix(client(), prefix)))
+         with cacheLock:
+            storeListing(cache, prefix, records)
+         metrics.add("prefixesListed")
+      else:
+         with cacheLock:
+            result["cached"] += 1
+         metrics.add("prefixesCached")
+      metrics.add("objectsListed", len(records))
+      metrics.add("bytesListed", sum([record.size for record in records]))
+      index = TimeIndex.build(records)
+      if indexFile and immutable: index.save(indexFile)
+      emit("filter", (prefix, index))
+   
+   # Filtering out files outside of the time window, with binary searches in the prefix's index
+   def filterStage(item, emit):
+      prefix, index = item
+      radar, dayStart = prefix[11:15], timegm(time.strptime(prefix[0:10], "%Y/%m/%d"))
+      if printFileList:
+         for i in range(len(index)):
+            write("{} {} {}".format(index.key(i), radar, np.datetime64(int(index.times[i]), 's')))
+      
+      def choose(caseWindows):
+         starts, ends = windowsFor(caseWindows, radar, dayStart, dayStart + 86400)
+         return index.select(starts, ends, thinInterval, everyNth)
+      
+      # Thinning picks different scans from a case's own windows than from the merged ones, so a
+      # batch downloads every scan some case chose instead of thinning the merged windows again
+      if cases:
+         chosen = []
+         for caseFile, caseWindows in cases:
+            chosen.append(choose(caseWindows))
+            result["caseScans"][caseFile][prefix] = index.times[chosen[-1]]
+         chosen = reduce(np.union1d, chosen)
+      else:
+         chosen = choose(windows)
+      selected = [index.record(i) for i in chosen]
+      metrics.add("filesSelected", len(selected))
+      metrics.add("bytesSelected", sum([record.size for record in selected]))
+      if selected:
+         emit("check", selected)
+      else:
+         prefixDone(prefix, emit)
    
-   # Print list of files to download if this setting is set
-   if printFileList:
-      print("Files to download:", flush = True)
-      for file in filesToDownload: print(file, flush = True)
+   # Skip files that the manifest of earlier downloads says are already complete. Files that are
+   # missing from it or have the wrong size (e.g. truncated downloads) are downloaded again, and
+   # so are symbolic links to volumes that were evicted from the shared store. Only the entries
+   # of the prefix being checked are read from the manifest, and files are only looked at on disk
+   # when the store links them symbolically.
+   symlinked = store is not None and store.linkMode == "sym"
+   
+   def checkStage(records, emit):
+      with manifestLock:
+         existingFiles = manifestEntries(manifest, records[0].key[:records[0].key.rfind('/') + 1])
+      toDownload = [record for record in records if not isComplete(record, existingFiles.get(record.key), part)
+                    or (symlinked and brokenLink(localPath(outputDir, record.key)))]
+      metrics.add("filesSkipped", len(records) - len(toDownload))
+      metrics.add("bytesSkipped", sum([record.size for record in records]) - sum([record.size for record in toDownload]))
+      if store is not None and download and not offline:
+         toDownload = linkFromStore(toDownload)
+      with manifestLock:
+         addToJournal(manifest, records, toDownload)
+      result["planned"] += len(records)
+      result["toDownload"] += len(toDownload)
+      if not download:
+         return
+      prefixDone(records[0].key[:records[0].key.rfind('/') + 1], emit, [record.key for record in records])
+      
+      # Files downloaded by earlier runs without --dc still get their uncompressed copy
+      if decompressWorkers:
+         pending = set([record.key for record in toDownload])
+         for record in records:
+            if record.key not in pending and not path.exists(uncompressedPath(outputDir, record.key)):
+               emit("decompress", record)
       
+      for record in toDownload:
+         if printFileList: write("To download: {}".format(record.key))
+         if offline:
+            continue
+         makedirs(path.dirname(localPath(outputDir, record.key)), exist_ok = True)
+         addBytes(0 if part else record.size)
+         emit("download", record)
+   
+   # Files in the shared store are linked into place, and the ones that are not are left to download
+   def linkFromStore(records):
+      linked = []
+      for record in records:
+         makedirs(path.dirname(localPath(outputDir, record.key)), exist_ok = True)
+         linkedPart = store.link(record, part, localPath(outputDir, record.key))
+         if linkedPart is not None:
+            linked.append((record, linkedPart))
+      if not linked:
+         return records
+      store.commit()
+      with manifestLock:
+         for record, linkedPart in linked:
+            recordDownload(manifest, record, linkedPart)
+         result["linked"] += len(linked)
+      metrics.add("filesFromStore", len(linked))
+      linkedKeys = set([record.key for record, linkedPart in linked])
+      return [record for record in records if record.key not in linkedKeys]
+   
+   def downloadStage(record, emit):
+      try:
+         scheduler.run(fetchFile, client(), record, outputDir, progress, sweeps, maxBytes, store)
+      except Exception as err:
+         write("Failed to download {}: {}".format(record.key, err))
+         metrics.add("filesFailed")
+         with manifestLock:
+            result["failed"].append(record)
+      else:
+         with manifestLock:
+            recordDownload(manifest, record, part)
+         if decompressWorkers: emit("decompress", record)
+      with barLock:
+         bars[0].set_postfix_str(pipeline.depths(), refresh = False)
+   
+   # NSE tables are pulled with one rsync per date and archive root, once every prefix of the
+   # date is through the check (or at the end, for dates with prefixes that failed)
+   nseLock = Lock()
+   nseRemaining, nseKeys = {}, {}
+   for prefix in prefixList:
+      yyyymmdd = prefix[0:10].replace('/', '')
+      nseRemaining[yyyymmdd] = nseRemaining.get(yyyymmdd, 0) + 1
+   
+   def prefixDone(prefix, emit, keys = []):
+      if not tables:
+         return
+      yyyymmdd = prefix[0:10].replace('/', '')
+      with nseLock:
+         nseKeys.setdefault(yyyymmdd, []).extend(keys)
+         nseRemaining[yyyymmdd] -= 1
+         keys = nseKeys.pop(yyyymmdd) if nseRemaining[yyyymmdd] == 0 else []
+      if keys: emit("nse", keys)
+   
+   # The index is made once per date at the end
+   def nseStage(keys, emit):
+      for yyyymmdd, patterns in planNSE(outputDir, keys, tables).items():
+         missing = pullNSEDate(outputDir, yyyymmdd, patterns, nseSource, index = False)
+         with manifestLock:
+            if len(missing) < len(patterns): result["nseDates"].add(yyyymmdd)
+            result["nseMissing"] += missing
+   
+   # Each thread of the stage waits on a process of the pool, so decompressing uses every core
+   # while the file that was just written is still in the page cache. A volume that cannot be
+   # decompressed is reported like a failed download, without holding up the rest of the run.
+   def decompressStage(record, emit):
+      try:
+         size = pool.submit(decompressVolume, localPath(outputDir, record.key),
+                            uncompressedPath(outputDir, record.key)).result()
+      except Exception as err:
+         write("Could not decompress {}: {}".format(record.key, err))
+         metrics.add("filesDecompressFailed")
+         return
+      metrics.add("filesDecompressed")
+      metrics.add("bytesDecompressed", size)
+   
+   decompressFeeds = ["decompress"] if decompressWorkers else []
+   pipeline = Pipeline()
+   pipeline.add("list", listStage, scheduler.maxWorkers, feeds = ["filter"])
+   pipeline.add("filter", filterStage, 1, feeds = ["check"])
+   pipeline.add("check", checkStage, 1, feeds = ["download", "nse"] + decompressFeeds)
+   pipeline.add("download", downloadStage, scheduler.maxWorkers, feeds = decompressFeeds)
+   pipeline.add("nse", nseStage, 4)
+   if decompressWorkers:
+      pipeline.add("decompress", decompressStage, decompressWorkers)
+   
+   print("Finding and downloading files for {} prefixes:".format(len(prefixList)), flush = True)
+   startJournal(manifest)
+   pool = decompressPool(decompressWorkers) if decompressWorkers else None
+   try:
+      # A saved plan goes straight to the check, without listing or filtering
+      if plan is None:
+         pipeline.run("list", prefixList)
+      else:
+         pipeline.run("check", plan)
+   finally:
+      if pool is not None: pool.shutdown()
+   for bar in bars: bar.close()
+   for yyyymmdd, keys in sorted(nseKeys.items()):
+      if keys: nseStage(keys, None)
+   
+   result["errors"] = 0
+   for name, stage in pipeline.stats().items():
+      metrics.stage(name, **stage)
+      result["errors"] += stage["errors"]
+   
+   # Shards leave the index to --vf, so two nodes never build it for the same date at once
+   for yyyymmdd in sorted(result["nseDates"]) if nseIndex else []:
+      indexNSE(outputDir, yyyymmdd)
+   for p in result["nseMissing"]:
+      print("Could not find {} at {}.".format(p, nseSource), flush = True)
+   
+   if plan is None:
+      print("{} of {} prefixes came from the listing cache.".format(result["cached"], len(prefixList)), flush = True)
+   if result["linked"]:
+      print("{} files were linked from the shared store in {}.".format(result["linked"], store.directory), flush = True)
+   if scheduler.retried:
+      print("{} retries ({} throttled by S3).".format(scheduler.retried, scheduler.throttled), flush = True)
+   if result["failed"]:
+      print("{} of {} files failed to download.".format(len(result["failed"]), result["toDownload"]),
+            flush = True)
+   pipeline.report()
+   
+   # The journal is kept until the whole plan is done so an interrupted run can be resumed. If a
+   # stage failed, planning did not finish and --rs will not pick it up.
+   if result["errors"]:
+      print("{} items failed in the pipeline.".format(result["errors"]), flush = True)
+   elif result["failed"] or offline or not download:
+      finishJournal(manifest)
+   else:
+      clearJournal(manifest)
+   
+   return result
+
+class Pipeline:
+   # Stages that each run on their own threads and hand items to each other through bounded
+   # queues, so a slow stage holds back the ones feeding it instead of letting work pile up
+   STOP = object()
+   
+   def __init__(self, queueSize = 64):
+      self.queueSize = queueSize
+      self.stages = {}
+      self.order = []
+      self.lock = Lock()
+   
+   def add(self, name, func, workers = 1, feeds = []):
+      # func(item, emit) is called for each item, and emit(stage, item) hands items on
+      self.stages[name] = {"func" : func, "workers" : max(1, workers), "feeds" : feeds,
+                           "queue" : Queue(self.queueSize), "producers" : 0, "running" : 0, "items" : 0,
+                           "busy" : 0.0, "maxDepth" : 0, "errors" : 0, "first" : None, "last" : None}
+      self.order.append(name)
+   
+   def emit(self, name, item):
+      stage = self.stages[name]
+      stage["queue"].put(item)
+      stage["maxDepth"] = max(stage["maxDepth"], stage["queue"].qsize())
+   
+   def run(self, name, items):
+      for stage in self.stages.values():
+         for feed in stage["feeds"]: self.stages[feed]["producers"] += 1
+      self.stages[name]["producers"] += 1
+      
+      # Stages before the one that is started are not used
+      for stage in self.stages.values():
+         if stage["producers"] == 0:
+            for worker in range(stage["workers"]): stage["queue"].put(Pipeline.STOP)
+      
+      threads = [Thread(target = self.work, args = (stageName,), daemon = True)
+                 for stageName in self.order for worker in range(self.stages[stageName]["workers"])]
+      for stageName in self.order: self.stages[stageName]["running"] = self.stages[stageName]["workers"]
+      for thread in threads: thread.start()
+      
+      for item in items:
+         self.emit(name, item)
+      self.producerDone(name)
+      
+      for thread in threads: thread.join()
+   
+   def work(self, name):
+      stage = self.stages[name]
+      while True:
+         item = stage["queue"].get()
+         if item is Pipeline.STOP:
+            break
+         
+         start = time.perf_counter()
+         try:
+            stage["func"](item, self.emit)
+         except Exception as err:
+            print("\nError in {} stage: {}".format(name, err), flush = True)
+            with self.lock:
+               stage["errors"] += 1
+         end = time.perf_counter()
+         
+         with self.lock:
+            stage["items"] += 1
+            stage["busy"] += end - start
+            stage["first"] = start if stage["first"] is None else min(stage["first"], start)
+            stage["last"] = end if stage["last"] is None else max(stage["last"], end)
+      
+      # The last worker of a stage to finish lets the stages it feeds know
+      with self.lock:
+         stage["running"] -= 1
+         last = stage["running"] == 0
+      if last:
+         for feed in stage["feeds"]: self.producerDone(feed)
+   
+   def producerDone(self, name):
+      stage = self.stages[name]
+      with self.lock:
+         stage["producers"] -= 1
+         done = stage["producers"] == 0
+      if done:
+         for worker in range(stage["workers"]): stage["queue"].put(Pipeline.STOP)
+   
+   def depths(self):
+      return " ".join(["{} {}".format(name, self.stages[name]["queue"].qsize()) for name in self.order])
+   
+   def stats(self):
+      return {name : {"items" : stage["items"], "busySeconds" : stage["busy"],
+                      "wallSeconds" : stage["last"] - stage["first"] if stage["items"] else 0.0,
+                      "maxQueue" : stage["maxDepth"], "errors" : stage["errors"]}
+              for name, stage in self.stages.items()}
+   
+   def report(self):
+      print("{:<10}{:>8}{:>11}{:>11}{:>11}{:>8}".format("Stage", "Items", "Busy (s)", "Items/s", "Max queue",
+            "Errors"), flush = True)
+      for name, stage in self.stats().items():
+         print("{:<10}{:>8}{:>11.2f}{:>11.1f}{:>11}{:>8}".format(name, stage["items"], stage["busySeconds"],
+               stage["items"] / stage["wallSeconds"] if stage["wallSeconds"] > 0 else 0.0, stage["maxQueue"],
+               stage["errors"]), flush = True)
+
+def runPlan(manifest, noaas3, plannedFiles, filesToDownload, outputDir, scheduler, endpointUrl, copyST, copyNRE,
+            nseSource = NSE_SOURCE, sweeps = -1, maxBytes = 0, decompressWorkers = 0, nseIndex = True, store = None):
    # Download files and make directories if they don't already exist
    print("Downloading files:", flush = True)
-   for file in tqdm(filesToDownload, file = sys.__stdout__):
-      if not path.exists(outputDir + '/' + file[file.rfind('/') + 5:file.rfind('/') + 13] +
-                         file[file.rfind('/'):file.rfind('/') + 5] + "/raw"):
-         system("mkdir -p {}/{}{}/raw".format(outputDir,file[file.rfind('/') + 5:file.rfind('/') + 13],
-                                              file[file.rfind('/'):file.rfind('/') + 5]))
-      
-      noaas3.download_file("noaa-nexrad-level2", file,
-                           outputDir + '/' + file[file.rfind('/') + 5:file.rfind('/') + 13] +
-                           file[file.rfind('/'):file.rfind('/') + 5] + "/raw" + file[file.rfind('/'):])
+   if noaas3 is None: noaas3 = makeS3Client(scheduler.maxWorkers, endpointUrl)
+   failed = downloadFiles(noaas3, filesToDownload, outputDir, scheduler, manifest, sweeps, maxBytes, store)
+   
+   if decompressWorkers:
+      failedKeys = set([file.key for file in failed])
+      decompressFiles(outputDir, [file.key for file in plannedFiles if file.key not in failedKeys], decompressWorkers)
    
    # Get NSE data for all new files
-   if copyST or copyNRE: pullNSE(outputDir, filteredFiles, copyST, copyNRE)
+   if copyST or copyNRE: pullNSE(outputDir, [file.key for file in plannedFiles], copyST, copyNRE, nseSource,
+                                 index = nseIndex)
+   
+   if not failed: clearJournal(manifest)
+   manifest.close()
    
-   return 0
+   return failed
 
-def getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol):
-   domains = [list(map(float, domain)) for domain in domains]
+def follow(outputDir, radars, scheduler, endpointUrl, duration = 0, minInterval = 10, maxInterval = 300,
+           lateness = 900, sweeps = -1, maxBytes = 0, store = None, clock = time.time):
+   # Polls only the part of each radar's current day after the newest key seen so far, and
+   # downloads new volumes as they show up. Every radar is polled again around when its next
+   # volume is due (from the spacing of its recent volumes, which follows the VCP), and more
+   # and more slowly while nothing new shows up. clock gives the current time, so a past day
+   # of a test bucket can be followed as if it were today.
+   print("Following {} radars{}:".format(len(radars), " for {} s".format(duration) if duration else ''),
+         flush = True)
+   noaas3 = makeS3Client(scheduler.maxWorkers, endpointUrl)
+   manifest = openManifest(outputDir)
+   
+   # Newest key, times of the last few volumes, and polls in a row with nothing new for each radar
+   lastKeys = {}
+   scanTimes = {radar : [] for radar in radars}
+   misses = {radar : 0 for radar in radars}
+   start = clock()
+   polls = [(start, radar) for radar in radars]
+   heapq.heapify(polls)
+   pending = {}
+   
+   with ThreadPoolExecutor(max_workers = scheduler.maxWorkers) as pool:
+      try:
+         while polls and (not duration or clock() - start < duration):
+            # Record finished downloads while waiting for the next radar to be due
+            timeout = max(0, polls[0][0] - clock())
+            if duration: timeout = min(timeout, max(0, start + duration - clock()))
+            done, notDone = wait(pending, timeout = timeout, return_when = FIRST_COMPLETED) if pending \
+                            else (set(), set())
+            if not pending: time.sleep(timeout)
+            for future in done:
+               record = pending.pop(future)
+               try:
+                  future.result()
+               except Exception as err:
+                  print("Failed to download {}: {}".format(record.key, err), flush = True)
+                  metrics.add("filesFailed")
+               else:
+                  recordDownload(manifest, record, volumePart(sweeps, maxBytes))
+                  print("Downloaded {}".format(record.key), flush = True)
+            if polls[0][0] > clock():
+               continue
+            
+            nextPoll, radar = heapq.heappop(polls)
+            now = clock()
+            
+            # Yesterday's prefix is polled too until late volumes of the day have had time to show up
+            days = sorted(set([time.strftime("%Y/%m/%d/", time.gmtime(now - lateness)),
+                               time.strftime("%Y/%m/%d/", time.gmtime(now))]))
+            # A listing that still fails after the retries is tried again later, backing off like a
+            # poll with nothing new, so S3 errors do not stop following
+            records = []
+            try:
+               for day in days:
+                  if radar in lastKeys and lastKeys[radar] > day + radar + '/~':
+                     continue
+                  records += scheduler.run(lambda: list(listPrefix(noaas3, day + radar + '/',
+                                                                   lastKeys.get(radar, ''))))
+            except Exception as err:
+               print("Failed to list {}: {}".format(radar, err), flush = True)
+               metrics.add("listingsFailed")
+               misses[radar] += 1
+               heapq.heappush(polls, (now + min(maxInterval, minInterval * 2 ** max(0, misses[radar] - 1)), radar))
+               continue
+            
+            newRadars, newTimes, newKeys = parseKeys([record.key for record in records])
+            if radar not in lastKeys:
+               # The first poll only finds where the radar is up to
+               print("{}: newest volume {}".format(radar, newKeys[-1] if len(newKeys) else "not found yet"),
+                     flush = True)
+            else:
+               objects = {record.key : record for record in records}
+               for key in newKeys:
+                  makedirs(path.dirname(localPath(outputDir, key)), exist_ok = True)
+                  pending[pool.submit(scheduler.run, fetchFile, noaas3, objects[key], outputDir,
+                                      scheduler.consume, sweeps, maxBytes, store)] = objects[key]
+            
+            lastKeys[radar] = str(newKeys[-1]) if len(newKeys) else lastKeys.get(radar, '')
+            scanTimes[radar] = (scanTimes[radar] + newTimes.astype(np.int64).tolist())[-10:]
+            misses[radar] = 0 if len(newKeys) else misses[radar] + 1
+            
+            # Next volume is due one cadence after the last one showed up; after that back off
+            if len(newKeys) and len(scanTimes[radar]) > 1:
+               cadence = float(np.median(np.diff(scanTimes[radar])))
+               delay = min(maxInterval, max(minInterval, 0.9 * cadence))
+            else:
+               delay = min(maxInterval, minInterval * 2 ** max(0, misses[radar] - 1))
+            heapq.heappush(polls, (now + delay, radar))
+      except KeyboardInterrupt:
+         print("\nStopped following.", flush = True)
+      
+      for future in as_completed(pending):
+         if future.exception() is None: recordDownload(manifest, pending[future], volumePart(sweeps, maxBytes))
+   manifest.close()
+
+def findCaseFiles(batch):
+   # A batch is a directory of case files, a glob, or a text file listing one case file per line
+   if path.isdir(batch):
+      return sorted([file for pattern in ["*.csv", "*.json", "*.jsonl"] for file in glob(path.join(batch, pattern))])
+   if path.isfile(batch) and not any(ext in batch for ext in [".csv", ".json"]):
+      with open(batch) as f:
+         return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+   return sorted(glob(batch))
+
+def reportCases(caseScans, cases, manifest, part = '', prefixList = []):
+   # How many of each case's files are in the manifest after a batch, and how many of its
+   # radar-days in this run were never checked (listing failed, or offline without a cache).
+   # Cases keep the scan times they selected from each prefix, which are matched by time.
+   prefixList = set(prefixList)
+   for caseFile, caseWindows in cases:
+      scans = caseScans[caseFile]
+      total, complete = 0, 0
+      for prefix, scanTimes in scans.items():
+         radars, times, keys = parseKeys([key for key, entry in manifestEntries(manifest, prefix).items()
+                                          if not entry[2] or entry[2] == part])
+         total += len(scanTimes)
+         complete += int(np.isin(scanTimes, times.astype(np.int64)).sum())
+      unchecked = len([prefix for prefix in prefixesForWindows(*caseWindows)
+                       if prefix in prefixList and prefix not in scans])
+      print("{}: {}/{} files complete{}".format(caseFile, complete, total,
+            ", {} radar-days not checked".format(unchecked) if unchecked else ''), flush = True)
+
+def makeS3Client(workers = 1, endpointUrl = None):
+   # One client is shared by every download thread, so the connection pool has to be
+   # at least as large as the number of workers. botocore's own retries are turned off so
+   # TransferScheduler sees every error and --tr bounds the retries.
+   import boto3
+   from botocore import UNSIGNED
+   from botocore.client import Config
+   
+   noaas3 = boto3.client("s3", region_name = "us-east-1", endpoint_url = endpointUrl,
+                         config = Config(signature_version = UNSIGNED, max_pool_connections = max(10, workers),
+                                         retries = {"total_max_attempts" : 1}))
+   noaas3.meta.events.register("before-send.s3", countRequest)
+   return noaas3
+
+# Counters for the requests sent to S3, by operation
+S3_REQUESTS = {"ListObjectsV2" : "s3ListRequests", "GetObject" : "s3GetRequests", "HeadObject" : "s3HeadRequests"}
+
+def countRequest(event_name = '', **kwargs):
+   # Every request the client sends, including the HeadObject and one GET per part that
+   # download_file makes. Returning nothing lets the request go ahead.
+   metrics.add(S3_REQUESTS.get(event_name.rsplit('.', 1)[-1], "s3OtherRequests"))
+
+def listPrefix(noaas3, prefix, startAfter = ''):
+   # Follow continuation tokens so prefixes with more than 1000 objects are not truncated
+   paginator = noaas3.get_paginator("list_objects_v2")
+   options = {"StartAfter" : startAfter} if startAfter else {}
+   for page in paginator.paginate(Bucket = BUCKET, Delimiter = '/', Prefix = prefix, **options):
+      for item in page.get("Contents", []):
+         yield S3Object(item["Key"], item["Size"], int(item["LastModified"].timestamp()),
+                        item.get("ETag", '').strip('"'))
+
+def openListingCache(cacheFile):
+   cache = sqlite3.connect(cacheFile, check_same_thread = False)
+   cache.execute("CREATE TABLE IF NOT EXISTS prefixes (prefix TEXT PRIMARY KEY, listed INTEGER, "
+                 "immutable INTEGER)")
+   cache.execute("CREATE TABLE IF NOT EXISTS objects (prefix TEXT, key TEXT PRIMARY KEY, size INTEGER, "
+                 "lastModified INTEGER, etag TEXT)")
+   cache.execute("CREATE INDEX IF NOT EXISTS objectsByPrefix ON objects (prefix)")
+   return cache
+
+def prefixImmutable(prefix, now = None):
+   # Prefixes look like YYYY/MM/DD/RADAR/
+   now = time.time() if now is None else now
+   return timegm(time.strptime(prefix[0:10], "%Y/%m/%d")) + 86400 + IMMUTABLE_AFTER < now
+
+def getCachedListing(cache, prefix, ttl, now = None):
+   # Returns None if the prefix has to be listed again
+   now = time.time() if now is None else now
+   row = cache.execute("SELECT listed, immutable FROM prefixes WHERE prefix = ?", (prefix,)).fetchone()
+   if row is None or (not row[1] and now - row[0] > ttl):
+      return None
+   return [S3Object(*item) for item in cache.execute("SELECT key, size, lastModified, etag FROM objects "
+                                                      "WHERE prefix = ? ORDER BY key", (prefix,))]
+
+def storeListing(cache, prefix, records, now = None):
+   now = time.time() if now is None else now
+   with cache:
+      cache.execute("DELETE FROM objects WHERE prefix = ?", (prefix,))
+      cache.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                        [(prefix,) + tuple(record) for record in records])
+      cache.execute("INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?)",
+                    (prefix, int(now), int(prefixImmutable(prefix, now))))
+
+def parseKeys(keys):
+   # Keys look like YYYY/MM/DD/RADAR/RADARYYYYMMDD_HHMMSS_V06, so every field is at a fixed
+   # position and all of the keys can be checked and parsed at once as a matrix of characters
+   keys = np.array(keys, dtype = 'U')
+   if len(keys) == 0:
+      return np.array([], dtype = "U4"), np.array([], dtype = "M8[s]"), keys
+   
+   raw = keys.astype("S{}".format(max(40, keys.itemsize // 4)))
+   chars = raw.view(np.uint8).reshape(len(raw), raw.itemsize)
+   digits = chars[:, 20:35].astype(np.int64) - ord('0')
+   
+   valid = (chars[:, 10] == ord('/')) & (chars[:, 15] == ord('/')) & (chars[:, 28] == ord('_')) & \
+           np.all(chars[:, 11:15] == chars[:, 16:20], axis = 1) & \
+           np.all(chars[:, 20:24] == chars[:, 0:4], axis = 1) & \
+           np.all(chars[:, 24:26] == chars[:, 5:7], axis = 1) & \
+           np.all(chars[:, 26:28] == chars[:, 8:10], axis = 1) & \
+           np.all((digits[:, [0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 11, 12, 13, 14]] >= 0) &
+                  (digits[:, [0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 11, 12, 13, 14]] <= 9), axis = 1) & \
+           ~np.char.endswith(raw, b"MDM") & ~np.char.endswith(raw, b".001")
+   
+   chars, digits, keys = chars[valid], digits[valid], keys[valid]
+   year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+   month = digits[:, 4] * 10 + digits[:, 5]
+   day = digits[:, 6] * 10 + digits[:, 7]
+   seconds = (digits[:, 9] * 10 + digits[:, 10]) * 3600 + (digits[:, 11] * 10 + digits[:, 12]) * 60 + \
+             digits[:, 13] * 10 + digits[:, 14]
+   times = ((year - 1970).astype("M8[Y]").astype("M8[M]") + (month - 1).astype("m8[M]")).astype("M8[D]") + \
+           (day - 1).astype("m8[D]")
+   times = times.astype("M8[s]") + seconds.astype("m8[s]")
+   radars = np.ascontiguousarray(chars[:, 16:20]).view("S4").ravel().astype("U4")
+   
+   return radars, times, keys
+
+def windowArrays(epochTime):
+   return (np.array([item["radar"] for item in epochTime], dtype = "U4"),
+           np.array([item["start"] for item in epochTime], dtype = np.int64),
+           np.array([item["end"] for item in epochTime], dtype = np.int64))
+
+def coalesceWindows(radars, starts, ends):
+   # Returns the smallest set of disjoint windows per radar that covers the same times.
+   # Windows are sorted by radar then start, and a new window begins wherever the start is
+   # after every earlier end of the same radar (plus one second, so adjacent windows merge).
+   if len(radars) == 0:
+      return radars, starts, ends
+   
+   order = np.lexsort((starts, radars))
+   radars, starts, ends = radars[order], starts[order], ends[order]
+   group = np.concatenate(([0], np.cumsum(radars[1:] != radars[:-1])))
+   
+   # Offsetting each radar's ends keeps the running maximum from carrying over between radars
+   offset = group * (int(ends.max()) - int(starts.min()) + 2)
+   reach = np.maximum.accumulate(ends - starts.min() + offset)
+   newWindow = np.ones(len(starts), dtype = bool)
+   newWindow[1:] = (group[1:] != group[:-1]) | (starts[1:] - starts.min() + offset[1:] > reach[:-1] + 1)
+   
+   firsts = np.flatnonzero(newWindow)
+   lasts = np.append(firsts[1:], len(starts)) - 1
+   return radars[firsts], starts[firsts], reach[lasts] - offset[lasts] + starts.min()
+
+def mergeWindowChunks(chunks):
+   # Windows are merged as each chunk arrives, so memory depends on how much radar time is
+   # covered and not on how many entries the input has
+   windows = (np.array([], dtype = "U4"), np.array([], dtype = np.int64), np.array([], dtype = np.int64))
+   numWindows = 0
+   for chunk in chunks:
+      numWindows += len(chunk[0])
+      windows = coalesceWindows(*[np.concatenate((old, new)) for old, new in zip(windows, chunk)])
+   return windows, numWindows
+
+def prefixesForWindows(radars, starts, ends):
+   # One YYYY/MM/DD/RADAR/ prefix for every day each window touches
+   firstDays, lastDays = starts // 86400, ends // 86400
+   numDays = lastDays - firstDays + 1
+   days = np.repeat(firstDays, numDays) + np.arange(numDays.sum()) - np.repeat(np.cumsum(numDays) - numDays, numDays)
+   pairs = set(zip(days.tolist(), np.repeat(radars, numDays).tolist()))
+   return sorted([(datetime(1970, 1, 1) + timedelta(days = day)).strftime("%Y/%m/%d/") + radar + '/'
+                  for day, radar in pairs])
+
+def windowsFor(windows, radar, start, end):
+   # Starts and ends of a radar's windows that overlap [start, end). Windows are sorted by radar
+   # and then time and do not overlap after coalesceWindows, so their ends are sorted too.
+   winRadars, winStarts, winEnds = windows
+   lo, hi = np.searchsorted(winRadars, radar, side = "left"), np.searchsorted(winRadars, radar, side = "right")
+   first = lo + np.searchsorted(winEnds[lo:hi], start, side = "left")
+   last = lo + np.searchsorted(winStarts[lo:hi], end, side = "left")
+   return winStarts[first:last], winEnds[first:last]
+
+class TimeIndex:
+   # Scan times of one radar-day in order, with where each key starts in a block of key bytes and
+   # what is needed to download it. Saved as two .npy files that are memory-mapped when loaded, so
+   # lookups are binary searches that only read the pages they need.
+   def __init__(self, entries, keyBytes):
+      self.entries, self.keyBytes = entries, keyBytes
+      self.times = entries["time"]
+   
+   @classmethod
+   def build(cls, records):
+      objects = {record.key : record for record in records}
+      radars, times, keys = parseKeys(sorted(objects))
+      order = np.argsort(times, kind = "stable")
+      keys = [str(key).encode() for key in keys[order]]
+      lengths = np.array([len(key) for key in keys], dtype = np.int64)
+      
+      entries = np.zeros(len(keys), dtype = INDEX_ENTRY)
+      entries["time"] = times[order].astype(np.int64)
+      entries["offset"] = np.cumsum(lengths) - lengths
+      entries["size"] = [objects[key.decode()].size for key in keys]
+      entries["lastModified"] = [objects[key.decode()].lastModified for key in keys]
+      entries["etag"] = [objects[key.decode()].etag.encode() for key in keys]
+      return cls(entries, np.frombuffer(b''.join(keys), dtype = np.uint8))
+   
+   @classmethod
+   def load(cls, file):
+      # The entries are saved last, so if they are there the keys are too
+      if not path.exists(file + ".npy"):
+         return None
+      return cls(np.load(file + ".npy", mmap_mode = 'r'), np.load(file + ".keys.npy", mmap_mode = 'r'))
+   
+   def save(self, file):
+      makedirs(path.dirname(file), exist_ok = True)
+      for suffix, array in [(".keys.npy", self.keyBytes), (".npy", self.entries)]:
+         with open(file + suffix + ".part", "wb") as f:
+            np.save(f, array)
+         replace(file + suffix + ".part", file + suffix)
+   
+   def __len__(self):
+      return len(self.entries)
+   
+   def key(self, i):
+      end = self.entries["offset"][i + 1] if i + 1 < len(self) else len(self.keyBytes)
+      return self.keyBytes[self.entries["offset"][i]:end].tobytes().decode()
+   
+   def record(self, i):
+      entry = self.entries[i]
+      return S3Object(self.key(i), int(entry["size"]), int(entry["lastModified"]), entry["etag"].decode())
+   
+   def records(self):
+      return [self.record(i) for i in range(len(self))]
+   
+   def between(self, starts, ends):
+      # Scans in any of the [start, end] windows, with a running count of open windows
+      first = np.searchsorted(self.times, starts, side = "left")
+      last = np.searchsorted(self.times, ends, side = "right")
+      openWindows = np.zeros(len(self) + 1, dtype = np.int64)
+      np.add.at(openWindows, first, 1)
+      np.add.at(openWindows, last, -1)
+      return np.flatnonzero(np.cumsum(openWindows[:-1]) > 0)
+   
+   def nearest(self, times):
+      # Scan closest to each time
+      if len(self) == 0:
+         return np.array([], dtype = np.int64)
+      right = np.clip(np.searchsorted(self.times, times), 0, len(self) - 1)
+      left = np.clip(right - 1, 0, len(self) - 1)
+      return np.where(np.abs(self.times[left] - times) <= np.abs(self.times[right] - times), left, right)
+   
+   def thin(self, start, end, interval):
+      # One scan per interval seconds from the start of the window: the one closest to each step
+      chosen = self.nearest(np.arange(start, end + 1, interval, dtype = np.int64))
+      return np.unique(chosen[(self.times[chosen] >= start) & (self.times[chosen] <= end)])
+   
+   def select(self, starts, ends, interval = 0, nth = 0):
+      if len(starts) == 0 or len(self) == 0:
+         return np.array([], dtype = np.int64)
+      if not interval and not nth:
+         return self.between(starts, ends)
+      
+      chosen = []
+      for start, end in zip(starts, ends):
+         scans = self.thin(start, end, interval) if interval else self.between([start], [end])
+         chosen.append(scans[::nth] if nth else scans)
+      return np.unique(np.concatenate(chosen))
+
+def localPath(outputDir, key):
+   name = key[key.rfind('/') + 1:]
+   return "{}/{}/{}/raw/{}".format(outputDir, name[4:12], name[0:4], name)
+
+def parseShard(shard):
+   # "i/N" is shard i (counting from 0) of N
+   try:
+      index, count = [int(part) for part in shard.split('/')]
+   except ValueError:
+      index, count = -1, 0
+   if not 0 <= index < count:
+      print("\"{}\" is not a valid shard. Use i/N with 0 <= i < N.".format(shard), flush = True)
+      return None
+   return index, count
+
+def shardOf(prefix, numShards):
+   # Which shard a radar-day (YYYY/MM/DD/RADAR/) belongs to. crc32 gives the same answer on every
+   # node, unlike hash().
+   return zlib.crc32(prefix.encode()) % numShards
+
+def shardSuffix(shard):
+   return ".shard{}of{}".format(*shard) if shard else ''
+
+def writePlan(planFile, manifest):
+   # One JSON object per file in the journal of the last run, in key order
+   with open(planFile + ".part", 'w') as f:
+      for row in manifest.execute("SELECT key, size, lastModified, etag FROM journal ORDER BY key"):
+         f.write(json.dumps(S3Object(*row)._asdict()) + '\n')
+   replace(planFile + ".part", planFile)
+
+def readPlan(planFile):
+   # Files of a saved plan by prefix, each held as a time index rather than a list of records.
+   # Plans are written in key order, so each prefix's lines come one after another.
+   plan, records = {}, []
+   
+   def addRecords():
+      prefix = records[0].key[:records[0].key.rfind('/') + 1]
+      if prefix in plan: records.extend(plan[prefix].records())
+      plan[prefix] = TimeIndex.build(records)
+      del records[:]
    
-   for domain in domains:
-      if not validDomain(domain):
-         print("Domain {} not valid. Deleting from list".format(domain), flush = True)
+   with open(planFile) as f:
+      for line in f:
+         if line.strip():
+            record = S3Object(**json.loads(line))
+            if records and not record.key.startswith(records[0].key[:records[0].key.rfind('/') + 1]):
+               addRecords()
+            records.append(record)
+   if records: addRecords()
+   return plan
+
+def verifyPlan(outputDir, planFile, part = ''):
+   # Every file of the plan has to be in one of the manifests (of the shards or of unsharded runs)
+   # and on disk. The shards' manifests are then merged into the main one, so later runs without
+   # --shard skip their files, and NSE indexes that the shards left for later are built.
+   plan = readPlan(planFile)
+   shards = sorted([(int(match.group(1)), int(match.group(2))) for match in
+                    [re.search(r"\.shard(\d+)of(\d+)\.sqlite$", file) for file in
+                     glob(outputDir + "/.downloadManifest.shard*.sqlite")] if match])
+   manifest = openManifest(outputDir)
+   for shard in shards:
+      shardManifest = openManifest(outputDir, shard = shard)
+      with manifest:
+         manifest.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                              shardManifest.execute("SELECT key, size, etag, lastModified, part FROM files"))
+      shardManifest.close()
+   
+   numShards = shards[0][1] if shards else 1
+   total, missing = {}, {}
+   for prefix, index in plan.items():
+      shard = shardOf(prefix, numShards)
+      total[shard] = total.get(shard, 0) + len(index)
+      entries = manifestEntries(manifest, prefix)
+      for record in index.records():
+         if not (isComplete(record, entries.get(record.key), part) and path.exists(localPath(outputDir, record.key))):
+            missing.setdefault(shard, []).append(record.key)
+   manifest.close()
+   
+   print("Merged {} shard manifests into the manifest of {}.".format(len(shards), outputDir), flush = True)
+   for index in sorted(total):
+      print("Shard {}/{}: {}/{} files complete".format(index, numShards, total[index] - len(missing.get(index, [])),
+            total[index]), flush = True)
+   for index, keys in sorted(missing.items()):
+      for key in keys[:10]:
+         print("   Missing {}".format(key), flush = True)
+      if len(keys) > 10:
+         print("   ... and {} more.".format(len(keys) - 10), flush = True)
+      print("Run {} again to fetch them.".format("shard {}/{}".format(index, numShards) if shards else "the plan"),
+            flush = True)
+   
+   for yyyymmdd in sorted(set([prefix[0:10].replace('/', '') for prefix in plan])):
+      if path.isdir("{}/{}/NSE".format(outputDir, yyyymmdd)):
+         indexNSE(outputDir, yyyymmdd)
+   
+   return 1 if missing else 0
+
+def uncompressedPath(outputDir, key):
+   # Uncompressed copies go next to raw/
+   name = key[key.rfind('/') + 1:]
+   return "{}/{}/{}/uncompressed/{}".format(outputDir, name[4:12], name[0:4], name)
+
+def decompressPool(workers):
+   # Processes are spawned rather than forked, since forking a process with threads running
+   # (downloads, boto3's connection pool) is not safe
+   import multiprocessing
+   from concurrent.futures import ProcessPoolExecutor
+   
+   return ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn"))
+
+def decompressFiles(outputDir, keys, workers):
+   # Uncompressed copies of downloaded volumes that do not have one yet
+   keys = [key for key in keys if path.exists(localPath(outputDir, key)) and
+           not path.exists(uncompressedPath(outputDir, key))]
+   if not keys:
+      return
+   print("Decompressing {} files:".format(len(keys)), flush = True)
+   with decompressPool(workers) as pool:
+      futures = {pool.submit(decompressVolume, localPath(outputDir, key), uncompressedPath(outputDir, key)) : key
+                 for key in keys}
+      for future in as_completed(futures):
          try:
-            domains.remove(domain)
-         except ValueError:
-            pass
+            metrics.add("bytesDecompressed", future.result())
+            metrics.add("filesDecompressed")
+         except Exception as err:
+            print("Could not decompress {}: {}".format(futures[future], err), flush = True)
+            metrics.add("filesDecompressFailed")
+
+def decompressVolume(source, target):
+   # Writes an uncompressed copy of an Archive II volume: the volume header followed by the
+   # messages of every LDM record, which is what readers expect of uncompressed volumes. Older
+   # gzipped volumes are gunzipped. Returns the size of the copy.
+   with open(source, "rb") as f:
+      data = f.read()
+   if data[:2] == b"\x1f\x8b":
+      data = gzip.decompress(data)
+   
+   blocks = [data[:VOLUME_HEADER]]
+   offset = VOLUME_HEADER
+   if data[offset + 4:offset + 7] == b"BZh":
+      while offset + 4 <= len(data):
+         size = abs(int.from_bytes(data[offset:offset + 4], "big", signed = True))
+         if size == 0:
+            break
+         blocks.append(bz2.decompress(data[offset + 4:offset + 4 + size]))
+         offset += 4 + size
+   else:
+      blocks.append(data[offset:])
+   
+   makedirs(path.dirname(target), exist_ok = True)
+   with open(target + ".part", "wb") as f:
+      for block in blocks: f.write(block)
+   replace(target + ".part", target)
+   return sum([len(block) for block in blocks])
+
+def openManifest(outputDir, rebuild = False, shard = None):
+   # Record of every file downloaded into outputDir, so existing files can be skipped without
+   # touching the file system. It is built from the directory tree the first time.
+   manifest = sqlite3.connect("{}/.downloadManifest{}.sqlite".format(outputDir, shardSuffix(shard)),
+                              check_same_thread = False)
+   # Size and ETag are the object's; part says if only some of it was fetched (see volumePart)
+   manifest.execute("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, size INTEGER, etag TEXT, "
+                    "lastModified INTEGER, part TEXT DEFAULT '')")
+   # Files planned by the last run that has not finished yet
+   manifest.execute("CREATE TABLE IF NOT EXISTS journal (key TEXT PRIMARY KEY, size INTEGER, "
+                    "lastModified INTEGER, etag TEXT, done INTEGER)")
+   manifest.execute("CREATE TABLE IF NOT EXISTS journalInfo (name TEXT PRIMARY KEY, value INTEGER)")
+   version = manifest.execute("PRAGMA user_version").fetchone()[0]
+   if version == 1:
+      # Manifests from before partial volumes only have whole files
+      with manifest:
+         manifest.execute("ALTER TABLE files ADD COLUMN part TEXT DEFAULT ''")
+         manifest.execute("PRAGMA user_version = 2")
+   if rebuild or version == 0:
+      print("Building manifest of files in {}:".format(outputDir), flush = True)
+      with manifest:
+         manifest.execute("DELETE FROM files")
+         manifest.executemany("INSERT OR REPLACE INTO files (key, size, etag, lastModified) VALUES (?, ?, ?, ?)",
+                              scanOutputDir(outputDir, shard))
+         manifest.execute("PRAGMA user_version = 2")
+   return manifest
+
+def scanOutputDir(outputDir, shard = None):
+   # Yields a manifest row for every file in outputDir/YYYYMMDD/RADAR/raw/ with one scandir walk
+   for day in scandir(outputDir):
+      if not (day.is_dir() and len(day.name) == 8 and day.name.isdigit()):
+         continue
+      for radar in scandir(day.path):
+         if not (radar.is_dir() and path.isdir(radar.path + "/raw")):
+            continue
+         prefix = "{}/{}/{}/{}/".format(day.name[0:4], day.name[4:6], day.name[6:8], radar.name)
+         if shard and shardOf(prefix, shard[1]) != shard[0]:
+            continue
+         for file in scandir(radar.path + "/raw"):
+            if file.is_file() and not file.name.endswith(".part"):
+               stat = file.stat()
+               yield ("{}/{}/{}/{}/{}".format(day.name[0:4], day.name[4:6], day.name[6:8], radar.name, file.name),
+                      stat.st_size, '', int(stat.st_mtime))
+
+def manifestEntries(manifest, prefix = ''):
+   # Entries of every file, or only of the files under one prefix (a range of the primary key)
+   if prefix:
+      rows = manifest.execute("SELECT key, size, etag, part FROM files WHERE key >= ? AND key < ?",
+                              (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+   else:
+      rows = manifest.execute("SELECT key, size, etag, part FROM files")
+   return {key : (size, etag, part) for key, size, etag, part in rows}
+
+def isComplete(record, entry, part = ''):
+   # The ETag is only compared when both sides have one (files found on disk do not). A whole
+   # file will do for any part, but a part will only do for the same part.
+   return entry is not None and entry[0] == record.size and \
+          (not entry[1] or not record.etag or entry[1] == record.etag) and (not entry[2] or entry[2] == part)
+
+def recordDownload(manifest, record, part = ''):
+   with manifest:
+      manifest.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                       (record.key, record.size, record.etag, record.lastModified, part))
+      manifest.execute("UPDATE journal SET done = 1 WHERE key = ?", (record.key,))
+
+def startJournal(manifest):
+   # The journal is filled in as files are planned and marked complete once planning is over
+   with manifest:
+      manifest.execute("DELETE FROM journal")
+      manifest.execute("INSERT OR REPLACE INTO journalInfo VALUES ('complete', 0)")
+
+def addToJournal(manifest, plannedFiles, filesToDownload):
+   pending = set([file.key for file in filesToDownload])
+   with manifest:
+      manifest.executemany("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)",
+                           [tuple(file) + (int(file.key not in pending),) for file in plannedFiles])
+
+def finishJournal(manifest):
+   with manifest:
+      manifest.execute("INSERT OR REPLACE INTO journalInfo VALUES ('complete', 1)")
+
+def readJournal(manifest):
+   # Returns every planned file, the ones that still have to be downloaded, and whether
+   # planning got to the end before the run stopped
+   rows = manifest.execute("SELECT key, size, lastModified, etag, done FROM journal ORDER BY key").fetchall()
+   complete = manifest.execute("SELECT value FROM journalInfo WHERE name = 'complete'").fetchone()
+   return [S3Object(*row[:4]) for row in rows], [S3Object(*row[:4]) for row in rows if not row[4]], \
+          bool(complete and complete[0])
+
+def clearJournal(manifest):
+   with manifest:
+      manifest.execute("DELETE FROM journal")
+      manifest.execute("DELETE FROM journalInfo")
+
+class SharedStore:
+   # Volumes shared by every output directory that uses the same store, addressed by key, ETag and
+   # part, so a volume another project already downloaded is linked into place instead of fetched
+   # again. Files are found by their path, so several runs can use the store at once; the SQLite
+   # table only keeps sizes and when each file was last used, for evicting the least recently
+   # used ones once the store is over budget (0 for no limit).
+   def __init__(self, directory, budget = 0, linkMode = "hard"):
+      makedirs(directory + "/objects", exist_ok = True)
+      self.directory, self.budget, self.linkMode = directory, budget, linkMode
+      self.db = sqlite3.connect(directory + "/.store.sqlite", timeout = 60, check_same_thread = False)
+      self.db.execute("CREATE TABLE IF NOT EXISTS objects (address TEXT PRIMARY KEY, key TEXT, etag TEXT, "
+                      "part TEXT, size INTEGER, lastUsed REAL)")
+      self.db.execute("CREATE INDEX IF NOT EXISTS objectsByUse ON objects (lastUsed)")
+      self.lock = Lock()
+      self.used = []
+      # Volumes this run linked or added, which it never evicts
+      self.inUse = set()
+      self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+   
+   def address(self, record, part):
+      return hashlib.sha1("{}\n{}\n{}".format(record.key, record.etag, part).encode()).hexdigest()
+   
+   def objectPath(self, address):
+      return "{}/objects/{}/{}".format(self.directory, address[0:2], address)
+   
+   def link(self, record, part, target):
+      # Returns the part that was linked (a whole volume will do for any part, as in the
+      # manifest), or None if the store does not have the volume
+      for storedPart in ([part, ''] if part else ['']):
+         address = self.address(record, storedPart)
+         try:
+            placeFile(self.objectPath(address), target, self.linkMode)
+         except FileNotFoundError:
+            continue
+         with self.lock:
+            self.used.append(address)
+            self.inUse.add(address)
+         return storedPart
+      return None
+   
+   def add(self, record, part, file):
+      address = self.address(record, part)
+      objectFile = self.objectPath(address)
+      if not path.exists(objectFile):
+         makedirs(path.dirname(objectFile), exist_ok = True)
+         temporary = "{}.{}.{}.part".format(objectFile, getpid(), get_ident())
+         if self.linkMode == "sym":
+            # The store keeps the file and the output directory gets a link to it
+            shutil.move(file, temporary)
+            replace(temporary, objectFile)
+            placeFile(objectFile, file, "sym")
          else:
+            placeFile(file, temporary, self.linkMode)
+            replace(temporary, objectFile)
+      size = path.getsize(objectFile)
+      with self.lock:
+         self.inUse.add(address)
+         with self.db:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                            (address, record.key, record.etag, part, size, time.time()))
+         self.total += size
+      self.commit()
+   
+   def commit(self):
+      # Saves when linked files were used and evicts files if the store is over budget
+      with self.lock:
+         used, self.used = self.used, []
+         now = time.time()
+         with self.db:
+            self.db.executemany("UPDATE objects SET lastUsed = ? WHERE address = ?",
+                                [(now, address) for address in used])
+         if self.budget and self.total > self.budget:
+            self.evict()
+   
+   def evict(self):
+      # Other runs may have added files too, so start from the size the table has. Files that are
+      # hardlinked into output directories only free space once those links are deleted too, and
+      # symbolic links to evicted files are downloaded again by the next run with --sl sym that checks them.
+      self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+      evicted = []
+      for address, size in self.db.execute("SELECT address, size FROM objects ORDER BY lastUsed").fetchall():
+         if self.total <= self.budget:
             break
+         if address in self.inUse:
+            continue
+         if path.exists(self.objectPath(address)): remove(self.objectPath(address))
+         evicted.append((address,))
+         self.total -= size
+      with self.db:
+         self.db.executemany("DELETE FROM objects WHERE address = ?", evicted)
+      metrics.add("filesEvicted", len(evicted))
+
+def placeFile(source, target, mode = "hard"):
+   # Puts a hard link, symbolic link or copy of source at target. Hard links fall back to copies
+   # across file systems, and copies are reflinks where the file system can make them.
+   if not path.exists(source):
+      raise FileNotFoundError(source)
+   temporary = "{}.{}.{}.link".format(target, getpid(), get_ident())
+   if mode == "hard":
+      try:
+         link(source, temporary)
+      except OSError:
+         copyFile(source, temporary)
+   elif mode == "sym":
+      symlink(path.abspath(source), temporary)
+   else:
+      copyFile(source, temporary)
+   replace(temporary, target)
+
+def brokenLink(file):
+   # Symbolic links into the shared store break when the store evicts what they point to
+   return path.islink(file) and not path.exists(file)
+
+def copyFile(source, target):
+   with open(source, "rb") as src, open(target, "wb") as dst:
+      try:
+         import fcntl
+         fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+      except (ImportError, OSError):
+         shutil.copyfileobj(src, dst)
+
+def fetchFile(noaas3, record, outputDir, progress, sweeps = -1, maxBytes = 0, store = None):
+   # Download next to the final path and only move the file into place once it is complete,
+   # so an interrupted download never looks like an existing file. With sweeps or maxBytes only
+   # the start of the volume is fetched (see fetchVolumePart). Finished files are added to the
+   # shared store, if there is one.
+   target = localPath(outputDir, record.key)
+   partial = target + ".part"
+   received = [0]
    
-   if len(domains) == 0:
-      print("No valid domains. Exiting.", flush = True)
-      exit()
+   def count(numBytes):
+      received[0] += numBytes
+      progress(numBytes)
+   
+   from boto3.s3.transfer import TransferConfig
    
-   # Read in CSV and store as a dataframe
    try:
-      rdf = pd.read_csv(radarFile, encoding = "ISO-8859-1")
-   except OSError as err:
-      print("Unable to read {}.".format(radarFile, err), flush = True)
-      exit()
-   
-   if (latName != '') and (latName in rdf):
-      lats = rdf[latName]
-   elif "lat" in rdf:
-      lats = rdf["lat"]
-   elif "LAT" in rdf:
-      lats = rdf["LAT"]
-   elif "latitude" in rdf:
-      lats = rdf["latitude"]
-   elif "LATITUDE" in rdf:
-      lats = rdf["LATITUDE"]
-   elif "lats" in rdf:
-      lats = rdf["lats"]
-   elif "LATS" in rdf:
-      lats = rdf["LATS"]
-   elif "latitudes" in rdf:
-      lats = rdf["latitudes"]
-   elif "LATITUDES" in rdf:
-      lats = rdf["LATITUDES"]
-   else:
-      print("Latitude column not found in {}.".format(radarFile), flush = True)
-      exit()
-   
-   if (latName != '') and (latName in rdf):
-      lons = rdf[latName]
-   elif "lon" in rdf:
-      lons = rdf["lon"]
-   elif "LON" in rdf:
-      lons = rdf["LON"]
-   elif "longitude" in rdf:
-      lons = rdf["longitude"]
-   elif "LONGITUDE" in rdf:
-      lons = rdf["LONGITUDE"]
-   elif "lons" in rdf:
-      lons = rdf["lons"]
-   elif "LATS" in rdf:
-      lons = rdf["LATS"]
-   elif "longitudes" in rdf:
-      lons = rdf["longitudes"]
-   elif "LONGITUDES" in rdf:
-      lons = rdf["LONGITUDES"]
-   else:
-      print("Longitude column not found in {}.".format(radarFile), flush = True)
-      exit()
+      size = fetchVolumePart(noaas3, record, partial, count, sweeps, maxBytes) if volumePart(sweeps, maxBytes) \
+             else None
+      if size is None:
+         # Transfers run on the calling thread so the scheduler controls how many are active
+         noaas3.download_file(BUCKET, record.key, partial, Callback = count,
+                              Config = TransferConfig(use_threads = False, num_download_attempts = 1))
+         verifyFile(partial, record)
+         size = record.size
+      elif path.getsize(partial) != size:
+         raise IOError("size is {} bytes instead of {}".format(path.getsize(partial), size))
+   except BaseException:
+      # Take back the progress of the failed attempt before it is retried
+      progress(-received[0])
+      if path.exists(partial): remove(partial)
+      raise
+   replace(partial, target)
+   metrics.add("filesDownloaded")
+   metrics.add("bytesDownloaded", size)
+   if store is not None: store.add(record, volumePart(sweeps, maxBytes), target)
+
+def volumePart(sweeps = -1, maxBytes = 0):
+   # Name of the part of a volume that is kept, for the manifest ('' for the whole volume)
+   return ','.join((["sweeps{}".format(sweeps)] if sweeps >= 0 else []) +
+                   (["bytes{}".format(maxBytes)] if maxBytes > 0 else []))
+
+def fetchVolumePart(noaas3, record, file, progress, sweeps = -1, maxBytes = 0, blockSize = 1 << 19):
+   # Fetches the volume header and whole LDM records with range requests until the records hold
+   # radials above the lowest `sweeps` elevations (0 keeps only the metadata record) or the next
+   # record would go past maxBytes. What is written is a valid, shorter volume. Returns its size,
+   # or None if the object is not a bzip2-compressed Archive II volume and has to be fetched whole.
+   reader = RangeReader(noaas3, record, progress, min(blockSize, maxBytes) if maxBytes else blockSize)
+   header = reader.read(0, VOLUME_HEADER + 4)
+   if not header.startswith(b"AR2V") or len(header) < VOLUME_HEADER + 4:
+      return None
+   
+   offset, written = VOLUME_HEADER, [header[:VOLUME_HEADER]]
+   while offset + 4 <= record.size:
+      size = abs(int.from_bytes(reader.read(offset, 4), "big", signed = True))
+      end = offset + 4 + size
+      if size == 0 or end > record.size:
+         return None
+      if maxBytes and end > maxBytes:
+         break
+      
+      # The first record is the metadata (VCP, site and calibration messages) and is always kept
+      block = reader.read(offset, 4 + size)
+      if sweeps >= 0 and offset > VOLUME_HEADER:
+         try:
+            elevation = firstElevation(bz2.decompress(block[4:]))
+         except (OSError, ValueError):
+            return None
+         if elevation is not None and elevation > sweeps:
+            break
+      written.append(block)
+      offset = end
+   
+   with open(file, "wb") as f:
+      for block in written: f.write(block)
+   return sum([len(block) for block in written])
+
+def firstElevation(data):
+   # Elevation number of the first radial in a decompressed LDM record, or None if it has none
+   offset = 0
+   while offset + MESSAGE_HEADER <= len(data):
+      messageType = data[offset + 15]
+      if messageType == 31:
+         return data[offset + MESSAGE_HEADER + 22] if offset + MESSAGE_HEADER + 22 < len(data) else None
+      if messageType == 1:
+         # Halfword 9 of the digital radar data; halfword 8 before it is the coded elevation angle
+         return int.from_bytes(data[offset + MESSAGE_HEADER + 16:offset + MESSAGE_HEADER + 18], "big")
+      offset += MESSAGE_SIZE
+   return None
+
+class RangeReader:
+   # Reads byte ranges of an S3 object through a buffer that is refilled a block at a time, so
+   # walking the records of a volume takes a few requests instead of one per record
+   def __init__(self, noaas3, record, progress, blockSize = 1 << 19):
+      self.noaas3, self.record, self.progress, self.blockSize = noaas3, record, progress, blockSize
+      self.start, self.buffer = 0, b''
+   
+   def read(self, offset, length):
+      end = min(offset + length, self.record.size)
+      if offset < self.start:
+         self.start, self.buffer = offset, b''
+      if end > self.start + len(self.buffer):
+         first = self.start + len(self.buffer)
+         last = min(self.record.size, max(end, first + self.blockSize)) - 1
+         
+         # Only ask for the same version of the object that was listed
+         options = {"IfMatch" : '"{}"'.format(self.record.etag)} if self.record.etag else {}
+         data = self.noaas3.get_object(Bucket = BUCKET, Key = self.record.key, Range = "bytes={}-{}".format(first, last),
+                                       **options)["Body"].read()
+         self.progress(len(data))
+         self.buffer += data
+      
+      # Drop what is before the offset; records are only ever read forwards
+      self.buffer, self.start = self.buffer[offset - self.start:], offset
+      return self.buffer[:end - offset]
+
+def verifyFile(file, record):
+   size = path.getsize(file)
+   if size != record.size:
+      raise IOError("size is {} bytes instead of {}".format(size, record.size))
+   
+   # ETags of objects that were not uploaded in parts are the MD5 of the object
+   if len(record.etag) == 32 and '-' not in record.etag:
+      md5 = hashlib.md5()
+      with open(file, "rb") as f:
+         for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+      if md5.hexdigest() != record.etag:
+         raise IOError("checksum {} does not match ETag {}".format(md5.hexdigest(), record.etag))
+
+def errorKind(err):
+   # Returns "throttle" if S3 asked us to slow down, "retry" if trying again may help, otherwise None
+   from botocore.exceptions import BotoCoreError, ClientError
+   
+   if isinstance(err, ClientError):
+      code = str(err.response.get("Error", {}).get("Code", ''))
+      status = str(err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", ''))
+      if code in THROTTLE_CODES or status in THROTTLE_CODES:
+         return "throttle"
+      if code in RETRY_CODES or status in RETRY_CODES:
+         return "retry"
+      return None
+   if isinstance(err, (BotoCoreError, IOError)):
+      return "retry"
+   return None
+
+class Metrics:
+   # Counters and stage timings of a run, for the JSON run report (--rep) and Prometheus text
+   # format (--prom). One instance is shared by the whole script and reset at the start of main.
+   def __init__(self):
+      self.lock = Lock()
+      self.reset()
+   
+   def reset(self):
+      with self.lock:
+         self.started = time.time()
+         self.counters = {}
+         self.stages = {}
+   
+   def add(self, name, value = 1):
+      with self.lock:
+         self.counters[name] = self.counters.get(name, 0) + value
+   
+   def stage(self, name, **values):
+      with self.lock:
+         stage = self.stages.setdefault(name, {})
+         for key, value in values.items():
+            stage[key] = stage.get(key, 0) + value
+   
+   def report(self):
+      with self.lock:
+         counters = dict(self.counters)
+         stages = {name : dict(stage) for name, stage in self.stages.items()}
+      downloadSeconds = stages.get("download", {}).get("wallSeconds", 0)
+      return {"started" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started)),
+              "seconds" : time.time() - self.started, "counters" : counters, "stages" : stages,
+              "downloadMBps" : counters.get("bytesDownloaded", 0) / 1e6 / downloadSeconds if downloadSeconds else 0.0}
+   
+   def prometheus(self, report, prefix = "level2_"):
+      # Counters are camelCase in the report and snake_case here
+      snake = lambda name: re.sub("([A-Z])", r"_\1", name).lower()
+      lines = []
+      for name, value in sorted(report["counters"].items()):
+         metric = prefix + snake(name) + "_total"
+         lines += ["# TYPE {} counter".format(metric), "{} {}".format(metric, value)]
+      for key in sorted(set([key for stage in report["stages"].values() for key in stage])):
+         metric = prefix + "stage_" + snake(key)
+         lines.append("# TYPE {} gauge".format(metric))
+         lines += ['{}{{stage="{}"}} {}'.format(metric, name, stage[key])
+                   for name, stage in sorted(report["stages"].items()) if key in stage]
+      for metric, value in [("run_seconds", report["seconds"]),
+                            ("download_bytes_per_second", report["downloadMBps"] * 1e6)]:
+         lines += ["# TYPE {}{} gauge".format(prefix, metric), "{}{} {}".format(prefix, metric, value)]
+      return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def writeReport(reportFile = '', promFile = ''):
+   # Files are written next to their final path and moved into place, so anything watching them
+   # (e.g. node_exporter's textfile collector) never reads half a report
+   report = metrics.report()
+   for file, text in [(reportFile, json.dumps(report, indent = 2) + '\n'), (promFile, metrics.prometheus(report))]:
+      if file:
+         with open(file + ".part", 'w') as f:
+            f.write(text)
+         replace(file + ".part", file)
+
+class TransferScheduler:
+   # Runs requests to S3 with per-request retries (exponential backoff with full jitter), a
+   # concurrency limit that is halved when S3 throttles and grows back by one after a limit's
+   # worth of successes, and an optional cap on the total download rate in bytes per second.
+   def __init__(self, maxWorkers = 8, retries = 5, backoff = 1.0, maxBackoff = 60.0, maxRate = 0):
+      self.maxWorkers = max(1, maxWorkers)
+      self.retries = retries
+      self.backoff = backoff
+      self.maxBackoff = maxBackoff
+      self.maxRate = maxRate
+      self.limit = self.maxWorkers
+      self.active = 0
+      self.successes = 0
+      self.retried = 0
+      self.throttled = 0
+      self.condition = Condition()
+      self.rateLock = Lock()
+      self.allowance = maxRate
+      self.lastRefill = time.monotonic()
+   
+   def run(self, func, *args, **kwargs):
+      attempt = 0
+      while True:
+         with self.condition:
+            while self.active >= self.limit:
+               self.condition.wait()
+            self.active += 1
+         
+         try:
+            result = func(*args, **kwargs)
+         except Exception as err:
+            kind = errorKind(err)
+            self.finished(kind)
+            if kind is None or attempt >= self.retries:
+               raise
+            attempt += 1
+            with self.condition:
+               self.retried += 1
+            metrics.add("retries")
+            time.sleep(random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt)))
+         else:
+            self.finished("success")
+            return result
+   
+   def finished(self, kind):
+      with self.condition:
+         self.active -= 1
+         if kind == "throttle":
+            self.throttled += 1
+            metrics.add("throttled")
+            self.successes = 0
+            self.limit = max(1, self.limit // 2)
+         elif kind == "success":
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maxWorkers:
+               self.successes = 0
+               self.limit += 1
+         self.condition.notify_all()
+   
+   def consume(self, numBytes):
+      # Token bucket holding at most one second of transfer
+      if self.maxRate <= 0 or numBytes <= 0:
+         return
+      with self.rateLock:
+         now = time.monotonic()
+         self.allowance = min(self.maxRate, self.allowance + (now - self.lastRefill) * self.maxRate) - numBytes
+         self.lastRefill = now
+         wait = -self.allowance / self.maxRate
+      if wait > 0:
+         time.sleep(wait)
+
+def downloadFiles(noaas3, files, outputDir, scheduler, manifest = None, sweeps = -1, maxBytes = 0, store = None):
+   # Make all of the output directories up front instead of checking for every file
+   for directory in set([path.dirname(localPath(outputDir, file.key)) for file in files]):
+      makedirs(directory, exist_ok = True)
+   
+   # Byte progress from all of the workers is combined into one bar
+   from tqdm import tqdm
+   lock = Lock()
+   part = volumePart(sweeps, maxBytes)
+   bar = tqdm(total = None if part else sum([file.size for file in files]), unit = 'B', unit_scale = True,
+              file = sys.__stdout__)
+   
+   def progress(numBytes):
+      scheduler.consume(numBytes)
+      with lock:
+         bar.update(numBytes)
+   
+   failed = []
+   start = time.perf_counter()
+   with ThreadPoolExecutor(max_workers = scheduler.maxWorkers) as pool:
+      futures = {pool.submit(scheduler.run, fetchFile, noaas3, file, outputDir, progress, sweeps, maxBytes,
+                             store) : file
+                 for file in files}
+      for done, future in enumerate(as_completed(futures), 1):
+         try:
+            future.result()
+         except Exception as err:
+            print("\nFailed to download {}: {}".format(futures[future].key, err), flush = True)
+            metrics.add("filesFailed")
+            failed.append(futures[future])
+         else:
+            if manifest is not None: recordDownload(manifest, futures[future], part)
+         with lock:
+            bar.set_postfix_str("{}/{} files".format(done, len(futures)))
+   bar.close()
+   metrics.stage("download", wallSeconds = time.perf_counter() - start, items = len(files))
+   
+   if scheduler.retried:
+      print("{} retries ({} throttled by S3).".format(scheduler.retried, scheduler.throttled), flush = True)
+   if failed:
+      print("{} of {} files failed to download.".format(len(failed), len(files)), flush = True)
+   
+   return failed
+
+def getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol, radarRange = 0):
+   domains = [list(map(float, domain)) for domain in domains]
+   
+   # Invalid domains get no radars so the rest stay lined up with their rows
+   valid = np.array([validDomain(domain) for domain in domains], dtype = bool)
+   for domain in [domain for domain, ok in zip(domains, valid) if not ok]:
+      print("Domain {} not valid. Skipping it.".format(domain), flush = True)
+   
+   if not valid.any():
+      raise ValueError("no valid domains")
+   
+   lats, lons, rads = loadRadarTable(radarFile, latName, lonName, radarCol)
+   
+   print("Finding radars in domains:", flush = True)
+   radars = [[] for domain in domains]
+   for index, inDomain in zip(np.flatnonzero(valid),
+                              radarsInDomains(np.array([domain for domain, ok in zip(domains, valid) if ok]),
+                                              lats, lons, radarRange)):
+      radars[index] = rads[inDomain].tolist()
+      
+   return radars
+
+@lru_cache(maxsize = None)
+def loadRadarTable(radarFile, latName, lonName, radarCol):
+   import pandas as pd
+   
+   # Read in CSV and store as a dataframe
+   rdf = pd.read_csv(radarFile, encoding = "ISO-8859-1")
+   
+   lats = findColumn(rdf, latName, ["lat", "latitude", "lats", "latitudes"])
+   if lats is None:
+      raise ValueError("latitude column not found in {}".format(radarFile))
+   
+   lons = findColumn(rdf, lonName, ["lon", "longitude", "lons", "longitudes"])
+   if lons is None:
+      raise ValueError("longitude column not found in {}".format(radarFile))
    
    if (radarCol != '') and (radarCol in rdf):
       rads = rdf[radarCol]
@@ -223,19 +1737,36 @@ def getRadarListFromDomain(domains, radarFile, latName, lonName, radarCol):
    elif "ICAO" in rdf:
       rads = rdf["ICAO"]
    else:
-      print("Radar ID column not found in {}.".format(radarFile), flush = True)
-      exit()
+      raise ValueError("radar ID column not found in {}".format(radarFile))
    
+   return lats.to_numpy(dtype = float), lons.to_numpy(dtype = float), rads.to_numpy(dtype = str)
+
+def findColumn(df, name, defaults):
+   if (name != '') and (name in df):
+      return df[name]
+   for column in defaults:
+      for option in [column, column.upper()]:
+         if option in df:
+            return df[option]
+   return None
+
+def radarsInDomains(domains, lats, lons, radarRange = 0, chunkSize = 4096):
    # 0 = [upper lat], 1 =  [lower lat], 2 = [left lon], 3 = [right lon]
-   print("Finding radars in domains:", flush = True)
-   radars = [[rad for lat, lon, rad in zip(lats, lons, rads)
-              if Point(lat, lon).within(polygon.Polygon([[domain[0], domain[2]],
-                                                         [domain[0], domain[3]],
-                                                         [domain[1], domain[3]],
-                                                         [domain[1], domain[2]]]))]
-              for domain in tqdm(domains, file = sys.__stdout__)]
+   # Domains are axis-aligned boxes, so every radar is tested against a block of domains at once.
+   # With a range (km), radars within that distance of the nearest point of a domain are kept too.
+   for first in range(0, len(domains), chunkSize):
+      chunk = domains[first:first + chunkSize, :, None]
+      inDomain = (lats < chunk[:, 0]) & (lats > chunk[:, 1]) & (lons > chunk[:, 2]) & (lons < chunk[:, 3])
       
-   return radars
+      if radarRange > 0:
+         nearLat = np.radians(np.clip(lats, chunk[:, 1], chunk[:, 0]))
+         nearLon = np.radians(np.clip(lons, chunk[:, 2], chunk[:, 3]))
+         lat, lon = np.radians(lats), np.radians(lons)
+         distance = 2 * 6371 * np.arcsin(np.sqrt(np.sin((nearLat - lat) / 2) ** 2 + np.cos(lat) *
+                                                 np.cos(nearLat) * np.sin((nearLon - lon) / 2) ** 2))
+         inDomain |= distance <= radarRange
+      
+      yield from inDomain
 
 def validDomain(dom):   
    if (len(dom) == 4) and (dom[0] > dom[1]) and (dom[2] < dom[3]) and \
@@ -260,55 +1791,79 @@ def validRadar(radar):
       return False
 
 def useCSV(file, radarName, radarSep, domainName, domainSep, timeStampName, startTimeName, endTimeName,
-           dateFormat, timeThreshold, radarFile, latName, lonName, radarCol):         
-   # Read in CSV and store as a dataframe
-   try:
-      if ".csv" in file:
-         df = pd.read_csv(file, encoding = "ISO-8859-1", low_memory = False)
-      elif ".json" in file:
-         df = pd.read_json(file)
+           dateFormat, timeThreshold, radarFile, latName, lonName, radarCol, radarRange = 0, chunkSize = 100000):
+   # Yields (radars, starts, ends) arrays for each chunk of the input file
+   # Read in CSV in chunks so large report archives never have to fit in memory at once. Files
+   # that cannot be used raise OSError or ValueError, so a batch can skip them.
+   import pandas as pd
+   
+   if ".csv" in file:
+      reader = pd.read_csv(file, encoding = "ISO-8859-1", dtype = str, chunksize = chunkSize)
+   elif ".jsonl" in file:
+      reader = pd.read_json(file, lines = True, dtype = False, chunksize = chunkSize)
+   elif ".json" in file:
+      reader = [pd.read_json(file, dtype = False)]
+   else:
+      raise ValueError("unrecognized file format")
+   
+   for df in reader:
+      if len(df) == 0:
+         continue
+      
+      if (not radarName in df and not domainName in df) or ((not timeStampName in df) and (not startTimeName in df or not endTimeName in df)) :
+         raise ValueError("\"{}\" and \"{}\" or \"{}\" and \"{}\" or \"{}\" not valid column name".format(
+                          radarName, domainName, timeStampName, startTimeName, endTimeName))
+      
+      raddom = domainName if domainName in df else radarName
+      
+      # Duplicates across chunks are taken care of when the windows are merged
+      if startTimeName in df and endTimeName in df:
+         df = df.drop_duplicates([startTimeName, endTimeName, raddom])
       else:
-         print("Unrecognized file format: {}\nExiting.".format(file))
-         exit()
-   except OSError as err:
-      print("Unable to read {}.".format(file, err), flush = True)
-      exit()      
-   
-   if (not radarName in df and not domainName in df) or ((not timeStampName in df) and (not startTimeName in df or not endTimeName in df)) :
-      print("\"{}\" and \"{}\" or \"{}\" and \"{}\" or \"{}\" not valid column name in {}.".format(radarName, domainName, timeStampName, startTimeName, endTimeName, file), flush = True)
-      exit()      
-   
-   raddom = domainName if domainName in df else radarName
-   
-   if ".csv" in file and startTimeName in df and endTimeName in df:
-      df = df.drop_duplicates([startTimeName, endTimeName, raddom])
-   elif ".csv" in file:
-      df = df.drop_duplicates([timeStampName, raddom])
-
-   if not radarName in df and domainName in df:
-      if not radarFile:
-         print("Need a list of NEXRAD radars with coordinate information to proceed. Please provide radar file path.")
-         exit()
-      if ".csv" in file:
-         radars = getRadarListFromDomain(df[domainName].apply(lambda x: [float(y) for y in x[1:-1].split(domainSep)]).values, radarFile, latName, lonName, radarCol)
+         df = df.drop_duplicates([timeStampName, raddom])
+
+      if not radarName in df and domainName in df:
+         if not radarFile:
+            raise ValueError("need a list of NEXRAD radars with coordinate information for domains. "
+                             "Please provide radar file path")
+         if isinstance(df[domainName].iloc[0], str):
+            radars = getRadarListFromDomain(df[domainName].apply(lambda x: [float(y) for y in x[1:-1].split(domainSep)]).values, radarFile, latName, lonName, radarCol, radarRange)
+         else:
+            radars = getRadarListFromDomain(df[domainName], radarFile, latName, lonName, radarCol, radarRange)
       else:
-         radars = getRadarListFromDomain(df[domainName], radarFile, latName, lonName, radarCol)
-   else:
-      radars = [[str(radar)] if radarSep not in str(radar) else str(radar).split(radarSep) for radar in df[radarName]]
-   # Get window aroud each CSV entry and which radar the time is associated with
-   if startTimeName in df and endTimeName in df:
-      epochTime = np.array([{"start" : timegm(time.strptime(s, dateFormat)),
-                             "end" : timegm(time.strptime(e, dateFormat)),
-                             "radar" : rad} for s, e, radar in zip(df[startTimeName], df[endTimeName], radars)
-                             for rad in radar if validRadar(rad) and validDate(s, dateFormat) and validDate(e, dateFormat)])  
-   else:
-      epochTime = np.array([{"start" : timegm(time.strptime(stamp, dateFormat)) - timeThreshold,
-                             "end" : timegm(time.strptime(stamp, dateFormat)) + timeThreshold,
-                             "radar" : rad} for stamp, radar in zip(df[timeStampName], radars)
-                             for rad in radar if validRadar(rad) and validDate(stamp, dateFormat)])
+         radars = df[radarName].astype(str).str.split(radarSep).tolist()
+      
+      # Get window aroud each entry; invalid dates become NaT and are dropped below
+      if startTimeName in df and endTimeName in df:
+         starts = parseTimes(df[startTimeName], dateFormat)
+         ends = parseTimes(df[endTimeName], dateFormat)
+      else:
+         stamps = parseTimes(df[timeStampName], dateFormat)
+         starts = np.where(stamps != NO_TIME, stamps - timeThreshold, NO_TIME)
+         ends = np.where(stamps != NO_TIME, stamps + timeThreshold, NO_TIME)
+      
+      # One window for each radar of each entry
+      counts = np.array([len(radar) for radar in radars], dtype = np.int64)
+      radars = np.array([rad for radar in radars for rad in radar], dtype = "U4")
+      starts, ends = np.repeat(starts, counts), np.repeat(ends, counts)
+      keep = validRadars(radars) & (starts != NO_TIME) & (ends != NO_TIME)
+      
+      yield radars[keep], starts[keep], ends[keep]
+
+def parseTimes(column, dateFormat):
+   # Returns UNIX times, with NO_TIME where the date does not match the format
+   import pandas as pd
    
-   print(epochTime)
-   return epochTime
+   times = pd.to_datetime(column.astype(str), format = dateFormat, errors = "coerce")
+   seconds = times.to_numpy(dtype = "M8[s]").astype(np.int64)
+   seconds[times.isna().to_numpy()] = NO_TIME
+   return seconds
+
+def validRadars(radars):
+   # Same checks as validRadar for an array of radar names
+   radars = np.asarray(radars, dtype = 'U')
+   return (np.char.str_len(radars) == 4) & np.char.isupper(radars) & \
+          (np.char.startswith(radars, 'K') | np.char.startswith(radars, 'P') | np.char.startswith(radars, 'T'))
 
 def useRangeAndRadar(start, end, radars, dateFormat):
    # Go through radars and make sure that all formats are valid
@@ -333,9 +1888,8 @@ def useRangeAndRadar(start, end, radars, dateFormat):
                break
          
    if (len(radars) != len(start)) or (sum(map(len, start)) != sum(map(len, end))):
-      print("There needs to be the same number of entries and/or start and end times. "
-            "All radars may have been removed for a case if no valid radars were found.", flush = True)
-      exit()
+      raise ValueError("there needs to be the same number of entries and/or start and end times. "
+                       "All radars may have been removed for a case if no valid radars were found")
    
    # Get epoch time for each entry 
    epochTime = np.array([{"start" : timegm(time.strptime(s, dateFormat)),
@@ -346,149 +1900,99 @@ def useRangeAndRadar(start, end, radars, dateFormat):
                           if validDate(s, dateFormat) and validDate(e, dateFormat)])
    return epochTime
 
-def pullNSE(directory, files, copyST, copyNRE):
+def pullNSE(directory, files, copyST, copyNRE, source = NSE_SOURCE, workers = 4, index = True):
+   # NSE tables are organized as [date]/NSE/[table]/[radar]/[date]-[hour]*, so all of the hours
+   # that are needed on a date can be fetched from a source with one rsync
+   tables = (["SoundingTable"] if copyST else []) + (["NearRadarEnvironmentTable"] if copyNRE else [])
+   plan = planNSE(directory, files, tables)
+   
+   print("Downloading NSE files for {} dates:".format(len(plan)), flush = True)
+   from tqdm import tqdm
+   missing = []
+   with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+      futures = [pool.submit(pullNSEDate, directory, yyyymmdd, patterns, source, index)
+                 for yyyymmdd, patterns in plan.items()]
+      for future in tqdm(as_completed(futures), total = len(futures), file = sys.__stdout__):
+         missing += future.result()
    
-   dateformat  = re.compile("\d{4}(0[1-9]|1[0-2])(0[1-9]|1[0-9]|2[0-9]|3[0-1])")
+   for p in missing:
+      print("Could not find {} at {}.".format(p, source), flush = True)
+   
+   return missing
+
+def planNSE(directory, files, tables):
+   # Patterns (relative to [date]/NSE/) of the NSE files needed on each date that are not here yet
+   dateformat  = re.compile(r"\d{4}(0[1-9]|1[0-2])(0[1-9]|1[0-9]|2[0-9]|3[0-1])")
    radarformat = re.compile("[K|P|T][A-Z]{3}")
    
-   opaths = list(set(["{}/NSE/SoundingTable/{}/{}-{}*".format(re.search(dateformat, file).group(0),
-                                                              re.search(radarformat, file).group(0),
-                                                              re.search(dateformat, file).group(0),
-                                                              re.search("_(.+?)\d{4}_", file).group(1))
-                      for file in files]))
+   plan = {}
+   for file in files:
+      try:
+         yyyymmdd = re.search(dateformat, file).group(0)
+         radar    = re.search(radarformat, file).group(0)
+         hour     = re.search(r"_(.+?)\d{4}_", file).group(1)
+      except AttributeError:
+         print("\nFormat not as expected: {}".format(file), flush = True)
+         continue
+      for table in tables:
+         plan.setdefault(yyyymmdd, set()).add("{}/{}/{}-{}*".format(table, radar, yyyymmdd, hour))
+   
+   missing = {}
+   for yyyymmdd, patterns in sorted(plan.items()):
+      patterns = [p for p in sorted(patterns) if not glob("{}/{}/NSE/{}".format(directory, yyyymmdd, p))]
+      if patterns: missing[yyyymmdd] = patterns
    
-   opaths.sort()
+   return missing
 
-   paths = [p for p in opaths if not glob("{}/{}".format(directory, p))]
+def pullNSEDate(directory, yyyymmdd, patterns, source = NSE_SOURCE, index = True):
+   # Try each archive root in turn, only asking the later ones for what is still missing, and
+   # build the index once at the end (unless the caller does it). Returns the patterns that were
+   # not found anywhere.
+   import tempfile
    
-   print("Downloading NSE files:", flush = True)
+   makedirs("{}/{}/NSE".format(directory, yyyymmdd), exist_ok = True)
+   missing = list(patterns)
+   fetched = False
+   for root in NSE_ROOTS:
+      if not missing:
+         break
       
-   for p in tqdm(paths, file = sys.__stdout__):
-      indexs = False
-      indexr = False
+      # rsync filter rules: the table and radar directories, then the files for each hour
+      rules = sorted(set(["/{}/".format(p.split('/')[0]) for p in missing] +
+                         ["/{}/".format('/'.join(p.split('/')[0:2])) for p in missing] +
+                         ['/' + p for p in missing]))
+      start = time.perf_counter()
+      with tempfile.NamedTemporaryFile("w", suffix = ".rules") as include:
+         include.write('\n'.join(rules) + '\n')
+         include.flush()
+         runCommand(["rsync", "-aumq", "--include-from=" + include.name, "--exclude=*",
+                     "{}/{}/{}/NSE/".format(source, root, yyyymmdd), "{}/{}/NSE/".format(directory, yyyymmdd)])
+      metrics.add("nseRsyncs")
+      metrics.add("nseRsyncSeconds", time.perf_counter() - start)
       
-      try:
-         yyyymmdd = re.search(dateformat, p).group(0)
-         radar    = re.search(radarformat, p).group(0)
-      except:
-         print("\nFormat not as expected: {}".format(p), flush = True)
-         continue
-         
-      if copyST:
-         if not path.exists("{}/{}/NSE/SoundingTable/{}".format(directory, yyyymmdd, radar)):
-            try:
-               system("mkdir -p {}/{}/NSE/SoundingTable/{} > /dev/null 2>&1".format(directory, yyyymmdd, radar))
-            except OSError as err:
-               print("\nError making directory: {}/{}/NSE/SoundingTable/{}\n{}\n".format(directory, yyyymmdd, radar, err), flush = True)
-               exit()
-         
-         try:
-            print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE/{} "
-                  "{}/{}/NSE/SoundingTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-            system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE/{} {}/{}/NSE/SoundingTable/{}/ "
-                   "> /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-            
-            indexs = True
-         except (KeyboardInterrupt):
-            break
-         except OSError as err:
-            print(err, flush = True)
-          
-         if not glob("{}/{}".format(directory, p)):
-            print("{}/{}".format(directory, p))
-            try:
-               print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                     "{}/{}/NSE/SoundingTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-               system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                      "{}/{}/NSE/SoundingTable/{}/ > /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-               
-               indexs = True
-            except (KeyboardInterrupt):
-               break
-            except OSError as err:
-               print(err, flush = True)
-            
-            if not glob("{}/{}".format(directory, p)):
-               try:
-                  p.replace("/NSE/SoundingTable", "/data6/NSE_Rebuild/NSE/SoundingTable")
-                  
-                  print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                        "{}/{}/NSE/SoundingTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-                  system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                         "{}/{}/NSE/SoundingTable/{}/ > /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-                  
-                  indexs = True
-               except (KeyboardInterrupt):
-                  break
-               except OSError as err:
-                  print(err, flush = True)
-                  print("\nCould not find any SoundingTable for: \n{}\n".format(p))
-               
-               if not glob("{}/{}".format(directory, p)):
-                  print("Could not find {} at hwtarchive.".format(p))
-                  indexs = False
-                        
-      # Near radar environment table
-      if copyNRE:
-         p.replace("/NSE/SoundingTable", "/NSE/NearRadarEnvironmentTable")
-         
-         if not path.exists("{}/{}/NSE/NearRadarEnvironmentTable/{}".format(directory, yyyymmdd, radar)):
-            try:
-               system("mkdir -p {}/{}/NSE/NearRadarEnvironmentTable/{} > /dev/null 2>&1".format(directory, yyyymmdd, radar))
-            except OSError as err:
-               print("\nError making directory: {}/{}/NSE/NearRadarEnvironmentTable/{}\n{}\n".format(directory, yyyymmdd, radar, err), flush = True)
-               exit()
-         
-         try:
-            print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE/{} "
-                  "{}/{}/NSE/NearRadarEnvironmentTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-            system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE/{} {}/{}/NSE/NearRadarEnvironmentTable/{}/ "
-                   "> /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-            
-            indexr = True
-         except (KeyboardInterrupt):
-            break
-         except OSError as err:
-            print(err, flush = True)
-          
-         if not glob("{}/{}".format(directory, p)):
-            print("{}/{}".format(directory, p))
-            try:
-               print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                     "{}/{}/NSE/NearRadarEnvironmentTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-               system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                      "{}/{}/NSE/NearRadarEnvironmentTable/{}/ > /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-               
-               indexr = True
-            except (KeyboardInterrupt):
-               break
-            except OSError as err:
-               print(err, flush = True)
-            
-            if not glob("{}/{}".format(directory, p)):
-               try:
-                  p.replace("/NSE/NearRadarEnvironmentTable", "/data6/NSE_Rebuild/NSE/NearRadarEnvironmentTable")
-                  
-                  print("\nrsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                        "{}/{}/NSE/NearRadarEnvironmentTable/{}/".format(p, directory, yyyymmdd, radar), flush = True)
-                  system("rsync -auq wdssii@hwtarchive.hwt.nssl:/data6/NSE_Rebuild/NSE_organized/{} "
-                         "{}/{}/NSE/NearRadarEnvironmentTable/{}/ > /dev/null 2>&1".format(p, directory, yyyymmdd, radar))
-
-                  
-                  indexr = True
-               except (KeyboardInterrupt):
-                  break
-               except OSError as err:
-                  print(err, flush = True)
-                  print("\nCould not find any NearRadarEnvironmentTable for: \n{}\n".format(p))
-               
-               if not glob("{}/{}".format(directory, p)):
-                  print("Could not find {} at hwtarchive.".format(p))
-                  indexr = False
-   
-      if indexs or indexr: system("makeIndex.pl {}/{}/NSE code_index.xml > /dev/null 2>&1".format(directory, yyyymmdd))
- 
-   return 0
+      stillMissing = [p for p in missing if not glob("{}/{}/NSE/{}".format(directory, yyyymmdd, p))]
+      fetched = fetched or len(stillMissing) < len(missing)
+      missing = stillMissing
+   
+   if fetched and index:
+      indexNSE(directory, yyyymmdd)
+   
+   return ["{}/NSE/{}".format(yyyymmdd, p) for p in missing]
+
+def indexNSE(directory, yyyymmdd):
+   start = time.perf_counter()
+   runCommand(["makeIndex.pl", "{}/{}/NSE".format(directory, yyyymmdd), "code_index.xml"])
+   metrics.add("nseIndexSeconds", time.perf_counter() - start)
+
+def runCommand(command):
+   # A failed command or missing program is reported and the run carries on
+   import subprocess
+   
+   try:
+      return subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode
+   except OSError as err:
+      print("\nCould not run {}: {}".format(command[0], err), flush = True)
+      return -1
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser(description = "Downloads NEXRAD level II radar data "
@@ -513,6 +2017,9 @@ if __name__ == "__main__":
                        help = "Path to csv/json with list of reports or events. This needs to have a column named "
                        "\"timestamp\" with format: \"YYYYmmdd-HHMM\" and one named \"radar\" or \"domain\""
                        "if you use the default settings.")
+   parser.add_argument("-b", metavar = "batch", type = str, nargs = '?', default = '',
+                       help = "Directory, glob (in quotes) or text file listing case files to plan and download "
+                       "together in one run. Uses the same column options as -i.")
    parser.add_argument("--ist", metavar = "startTimeName", type = str, nargs = '?',
                        default = "startDate", help = "Column name for the radar from "
                        "the input file. Default = %(default)s.")
@@ -540,6 +2047,9 @@ if __name__ == "__main__":
    parser.add_argument("--nre", metavar = "copyNRE", type = bool, nargs = '?', 
                        default = False, help = "If true, get NSE near radar environment "
                        "data from hwtarchive. Only works if -n is True. Default = %(default)s")
+   parser.add_argument("--nsrc", metavar = "nseSource", type = str, nargs = '?', default = NSE_SOURCE,
+                       help = "rsync source with the NSE archive roots (NSE, NSE_Rebuild/...). "
+                       "Default = %(default)s")
    parser.add_argument("-o", metavar = "outputDir", type = str,  nargs = '?', 
                        default = "temp", help = "Path to output directory. Default = %(default)s")
    parser.add_argument("-p", metavar = "printFileList", type = bool, nargs = '?', default = False,
@@ -566,11 +2076,121 @@ if __name__ == "__main__":
    "The script will download all files +- %(default)d s ({} min) by default".format(defaultValue/60)
    parser.add_argument("-t", metavar = "timeThreshold", type = int, nargs = '?', 
                        default = defaultValue, help = msg)
+   parser.add_argument("-w", metavar = "workers", type = int, nargs = '?', default = 8,
+                       help = "Number of files to download at the same time. Default = %(default)s.")
+   parser.add_argument("--ep", metavar = "endpointUrl", type = str, nargs = '?', default = None,
+                       help = "S3 endpoint to download from instead of AWS (e.g. a local MinIO "
+                       "server or mirror of the bucket).")
+   parser.add_argument("--rng", metavar = "radarRange", type = float, nargs = '?', default = 0,
+                       help = "Also use radars within this many km of a domain (e.g. 230) instead of "
+                       "only radars inside it. Default = %(default)s.")
+   parser.add_argument("--cs", metavar = "chunkSize", type = int, nargs = '?', default = 100000,
+                       help = "Number of rows of the input file to read at a time. Default = %(default)s.")
+   parser.add_argument("--lc", metavar = "cacheFile", type = str, nargs = '?', default = '',
+                       help = "Path to the SQLite cache of bucket listings. Days that are over are "
+                       "never listed again. Default = [outputDir]/.listingCache.sqlite")
+   parser.add_argument("--lt", metavar = "cacheTTL", type = int, nargs = '?', default = 300,
+                       help = "Seconds before listings of days that are not over yet are refreshed. "
+                       "Default = %(default)s.")
+   parser.add_argument("--off", action = "store_true", help = "Only use the listing cache and do not "
+                       "download anything. Use with -p to print the planned file list offline.")
+   parser.add_argument("--mr", action = "store_true", help = "Rebuild the manifest of downloaded files "
+                       "from the output directory (e.g. after files were moved or deleted by hand).")
+   parser.add_argument("--tr", metavar = "retries", type = int, nargs = '?', default = 5,
+                       help = "Number of times to retry a failed or throttled request. Default = %(default)s.")
+   parser.add_argument("--bw", metavar = "maxRate", type = float, nargs = '?', default = 0,
+                       help = "Cap on the total download rate in MB/s (0 for no cap). Default = %(default)s.")
+   parser.add_argument("--fl", action = "store_true", help = "Follow the radars (--rad or --dom) and "
+                       "download new volumes as soon as they show up in the bucket, until stopped.")
+   parser.add_argument("--fd", metavar = "followDuration", type = float, nargs = '?', default = 0,
+                       help = "Stop following after this many seconds (0 for never). Default = %(default)s.")
+   parser.add_argument("--rs", action = "store_true", help = "Resume the downloads planned by an "
+                       "interrupted run in the output directory without listing the bucket again.")
+   parser.add_argument("--sw", metavar = "sweeps", type = int, nargs = '?', default = -1,
+                       help = "Only fetch the volume header, metadata and the radials of the lowest this many "
+                       "elevation cuts of each volume with range requests (0 for only the header and metadata). "
+                       "Split cuts count twice, so 2 is the lowest tilt. Default = whole volumes.")
+   parser.add_argument("--fb", metavar = "maxBytes", type = int, nargs = '?', default = 0,
+                       help = "Only fetch the whole LDM records within the first this many bytes of each volume. "
+                       "Default = whole volumes.")
+   parser.add_argument("--dc", action = "store_true", help = "Also write an uncompressed copy of each volume "
+                       "to YYYYMMDD/RADAR/uncompressed/, using a pool of processes while downloads continue.")
+   parser.add_argument("--dw", metavar = "decompressWorkers", type = int, nargs = '?', default = 0,
+                       help = "Number of processes decompressing volumes with --dc. Default = number of CPUs.")
+   parser.add_argument("--ti", metavar = "thinInterval", type = int, nargs = '?', default = 0,
+                       help = "Only download the volume closest to every this many seconds of each window "
+                       "(e.g. 600 for one volume per 10 minutes). Default = every volume.")
+   parser.add_argument("--en", metavar = "everyNth", type = int, nargs = '?', default = 0,
+                       help = "Only download every Nth volume of each window. Default = every volume.")
+   parser.add_argument("--shard", metavar = "i/N", type = str, nargs = '?', default = '',
+                       help = "Only handle the radar-days of shard i of N (counting from 0), so N nodes can "
+                       "share the work and the output directory. Each shard keeps its own manifest.")
+   parser.add_argument("--sp", metavar = "planFile", type = str, nargs = '?', default = '',
+                       help = "Save the list of files to download (one JSON object per line) instead of "
+                       "downloading them.")
+   parser.add_argument("--up", metavar = "planFile", type = str, nargs = '?', default = '',
+                       help = "Download the files of a plan saved with --sp instead of reading a case file.")
+   parser.add_argument("--vf", metavar = "planFile", type = str, nargs = '?', default = '',
+                       help = "Check that every file of a plan was downloaded by one of the shards, merge "
+                       "the shards' manifests and build the NSE indexes. Exits with 1 if files are missing.")
+   parser.add_argument("--st", metavar = "storeDir", type = str, nargs = '?', default = '',
+                       help = "Shared store of volumes that several output directories can use. Volumes "
+                       "already in it are linked into the output directory instead of downloaded, and new "
+                       "downloads are added to it.")
+   parser.add_argument("--sb", metavar = "budget", type = float, nargs = '?', default = 0,
+                       help = "Size of the shared store in GB. The least recently used volumes are removed "
+                       "when it gets bigger. Default = no limit.")
+   parser.add_argument("--sl", metavar = "linkMode", type = str, nargs = '?', default = "hard",
+                       choices = ["hard", "sym", "copy"],
+                       help = "How volumes from the shared store are put in the output directory: hard "
+                       "links, symbolic links to the store, or copies (reflinks where the file system "
+                       "supports them). Default = %(default)s.")
+   parser.add_argument("--rep", metavar = "reportFile", type = str, nargs = '?', default = '',
+                       help = "Save a JSON report of the run (stage timings, S3 requests, files and bytes "
+                       "listed/downloaded/skipped, transfer rate, retries, NSE rsync times) to this file.")
+   parser.add_argument("--prom", metavar = "promFile", type = str, nargs = '?', default = '',
+                       help = "Save the same counters in Prometheus text format to this file.")
+   parser.add_argument("--profile", metavar = "profileFile", type = str, nargs = '?', default = '',
+                       help = "Run under cProfile, save the stats to this file and print the top functions. "
+                       "Every thread is profiled and the stats of all of them are combined.")
    args = parser.parse_args(sys.argv[1:])
-       
-   main(outputDir = args.o, dateFormat = args.d, startDates = args.ds, endDates = args.de,
-        inputFile = args.i, copyST = args.nst, copyNRE = args.nre, printFileList = args.p,
-        radars = args.rad, startTimeName = args.ist, endTimeName = args.iet,
-        radarName = args.ir, radarSep = args.irs, timeStampName = args.it, domainName = args.id, domainSep = args.ids, timeThreshold = args.t,
-        domains = args.dom, radarFile = args.rf, latName = args.rt, lonName = args.rn, radarCol = args.rr)
+   
+   if args.profile:
+      import cProfile, threading
+      profilers = [cProfile.Profile()]
+      
+      # Most of the work happens on worker threads, so each new thread gets a profiler of its own
+      # the first time it runs any Python code
+      def profileThread(*ignored):
+         profilers.append(cProfile.Profile())
+         profilers[-1].enable()
+      threading.setprofile(profileThread)
+      profilers[0].enable()
+   
+   # The profile and the report are saved even if the run fails or is interrupted
+   status = 1
+   try:
+      status = main(outputDir = args.o, dateFormat = args.d, startDates = args.ds, endDates = args.de,
+           inputFile = args.i, copyST = args.nst, copyNRE = args.nre, printFileList = args.p,
+           radars = args.rad, startTimeName = args.ist, endTimeName = args.iet,
+           radarName = args.ir, radarSep = args.irs, timeStampName = args.it, domainName = args.id, domainSep = args.ids, timeThreshold = args.t,
+           domains = args.dom, radarFile = args.rf, latName = args.rt, lonName = args.rn, radarCol = args.rr,
+           workers = args.w, endpointUrl = args.ep, cacheFile = args.lc, cacheTTL = args.lt,
+           offline = args.off, radarRange = args.rng, chunkSize = args.cs,
+           rebuildManifest = args.mr, resume = args.rs,
+           retries = args.tr, maxRate = args.bw, batch = args.b,
+           followMode = args.fl, followDuration = args.fd, nseSource = args.nsrc, sweeps = args.sw, maxBytes = args.fb,
+           decompress = args.dc, decompressWorkers = args.dw, thinInterval = args.ti, everyNth = args.en,
+           shard = args.shard, savePlan = args.sp, usePlan = args.up, verifyPlanFile = args.vf,
+           storeDir = args.st, storeBudget = args.sb, linkMode = args.sl)
+   finally:
+      if args.profile:
+         import pstats
+         profilers[0].disable()
+         threading.setprofile(None)
+         stats = pstats.Stats(*profilers, stream = sys.stdout)
+         stats.dump_stats(args.profile)
+         stats.sort_stats("cumulative").print_stats(20)
+      writeReport(args.rep, args.prom)
+   sys.exit(status if status else 0)
    